@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""Offline benchmarks of the bpauto pipeline on synthetic configs.
+
+Every axis scales one dimension of a small base config: interfaces, VLANs,
+IP routers, IP static hosts, superflow transaction size or the number of
+superflows behind an AUTOMATIC component. Each point runs in a fresh process
+through the same steps as bpauto, without connecting to a tester, and
+records per stage
+
+    seconds      wall time of the stage
+    peak_rss_kb  process high-water mark once the stage is done
+    bytes        TCL (or payload) bytes the stage emitted
+
+With -L the whole config is also run through a live session against the
+stub Tcl shell (live_stub.tcl), timing generation and execution together.
+
+Every run first checks the import budget: importing bpauto in a fresh
+interpreter must not load yaml, paramiko or scp and must take at most
+IMPORT_BUDGET_MS (best of a few runs). A failing check stops the run, and -i
+runs only this check.
+
+Results are written as JSON, e.g.
+
+    python3 bench.py -a hosts -a vlans -o bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
+
+from netplan import format_ipv4
+
+AXES = {
+    'interfaces': [2, 16, 64, 254],
+    'vlans': [16, 256, 1024, 4096],
+    'routers': [16, 256, 1024, 1998],
+    'hosts': [8, 1000, 10000, 100000],
+    'tsize': [10000, 1000000, 10000000, 100000000],
+    'automatic': [1, 10, 100, 500],
+}
+
+QUICK_AXES = {axis: values[:2] for axis, values in AXES.items()}
+
+BASE = {'interfaces': 8, 'vlans': 0, 'routers': 0, 'hosts': 8, 'tsize': 100000, 'automatic': 4}
+
+# Importing bpauto must not load these and must take at most IMPORT_BUDGET_MS
+DEFERRED_MODULES = ('yaml', 'paramiko', 'scp')
+IMPORT_BUDGET_MS = 150
+IMPORT_PROBE = ('import sys, time\n'
+                'start = time.perf_counter()\n'
+                'import bpauto\n'
+                'print(time.perf_counter() - start)\n'
+                'print(" ".join(sorted(set(sys.argv[1:]) & set(sys.modules))))\n')
+
+# Host blocks hold at most MAX_NAME_INDEX - 1 hosts, a /24 each
+HOSTS_PER_BLOCK = 999
+HOST_STEP = 256
+
+# Superflow applications cycled through, one per kind of superflow modification
+APPLICATIONS = ('HTTP', 'HTTPS_SIM', 'SYSLOG', 'ORACLE_SELECT')
+FILE_TYPES = ('asterisk', 'binary', 'ascii')
+
+
+def _split(count, limit):
+    """Split count into parts of at most limit."""
+    return [min(limit, count - start) for start in range(0, count, limit)]
+
+
+def _host_blocks(side, count, container, base, peer):
+    blocks = []
+    for index, size in enumerate(_split(count, HOSTS_PER_BLOCK)):
+        start = base + index * HOSTS_PER_BLOCK * HOST_STEP
+        blocks.append({'Name': '{0}{1:03d}_'.format(side, index),
+                       'Container': container,
+                       'IP Address': format_ipv4([start + 1])[0],
+                       'IP Count': 100,
+                       'Netmask': 24,
+                       'Gateway': format_ipv4([start + 254])[0],
+                       'Increment Mask': '0.0.1.0',
+                       'Count': size,
+                       'Path': '{0}{1:03d}_'.format(peer, index)})
+    return blocks
+
+
+def synthetic_config(interfaces, vlans, routers, hosts, tsize, automatic):
+    """A config with the given number of elements, split evenly between clients and servers."""
+    network = {'Name': 'Bench',
+               'Interfaces': [{'Name': side + 'Int', 'Duplicate MAC address': True,
+                               'Count': max(1, interfaces // 2), 'Start Number': number, 'Increment': 2}
+                              for side, number in (('Client', 1), ('Server', 2))]}
+    containers = {'Client': 'ClientInt', 'Server': 'ServerInt'}
+    if vlans:
+        network['VLANs'] = [{'Name': side + 'VLAN', 'Container': containers[side], 'Duplicate MAC address': True,
+                             'VLAN ID': 1, 'Increment': 1, 'Count': max(1, vlans // 2)}
+                            for side in ('Client', 'Server')]
+        containers = {'Client': 'ClientVLAN', 'Server': 'ServerVLAN'}
+    if routers:
+        network['IP Routers'] = [{'Name': side + 'Router', 'Container': containers[side],
+                                  'IP Address': '{0}.0.0.1'.format(address), 'Netmask': 24,
+                                  'Gateway': '{0}.0.0.254'.format(address), 'Increment Mask': '0.0.1.0',
+                                  'Count': max(1, routers // 2)}
+                                 for side, address in (('Client', 10), ('Server', 20))]
+        containers = {'Client': 'ClientRouter', 'Server': 'ServerRouter'}
+    network['IP Static Hosts'] = (
+        _host_blocks('Clients', max(1, hosts // 2), containers['Client'], 1 << 24, 'Servers') +
+        _host_blocks('Servers', max(1, hosts // 2), containers['Server'], 128 << 24, 'Clients'))
+
+    superflows = [{'Name': 'SF{0}'.format(index), 'Application': APPLICATIONS[index % len(APPLICATIONS)],
+                   'Transation Size': tsize}
+                  for index in range(automatic)]
+    return {
+        'General': {'Prefix': 'BENCH '},
+        'Connection': {'Tester IP': '192.168.1.1', 'Login': 'admin', 'Password': 'admin'},
+        'Network': network,
+        'Super Flows': superflows,
+        'Application Profiles': [{'Name': 'Mix', 'Weight According to': 'flows',
+                                  'Super Flows': [{'Name': superflow['Name'], 'Weight': index % 7 + 1}
+                                                  for index, superflow in enumerate(superflows)]}],
+        'Test': {'Name': 'Bench', 'Network': 'Bench',
+                 'Components': [{'Name': 'AUTOMATIC', 'Type': 'appsim', 'Application Profile': 'Mix',
+                                 'Ramp Up Duration': 30, 'Steady State Duration': 180, 'Ramp Down Duration': 15,
+                                 'Max Sessions': 1000000, 'Max Sessions per sec': 100000,
+                                 'Client Tags': 'Clients000_', 'Server Tags': 'Servers000_'}]},
+    }
+
+
+class Stages(object):
+    """Collects the measurements of consecutive stages.
+
+    Once autobp is set, a stage's bytes are the TCL it emitted, before that
+    they are whatever the stage function returns.
+    """
+    def __init__(self):
+        self.autobp = None
+        self.results = {}
+
+    def run(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        if self.autobp is not None:
+            create, delete = self.autobp.tfiles.take()
+            emitted = len(create) + len(delete)
+        else:
+            emitted = result
+        self.results[name] = {'seconds': round(seconds, 6),
+                              'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                              'bytes': emitted}
+        return result
+
+
+def _load(conf, directory):
+    import yaml
+    from config import load_config
+    path = os.path.join(directory, 'bench.yaml')
+    with open(path, 'w') as conffile:
+        yaml.safe_dump(conf, conffile, sort_keys=False)
+    load_config(path, use_cache=False)
+    return os.path.getsize(path)
+
+
+def _payloads(conf, directory):
+    from payload import PayloadFile
+    payload = PayloadFile()
+    size = conf['Super Flows'][0]['Transation Size']
+    for filetype in FILE_TYPES:
+        payload.generate_file(os.path.join(directory, filetype), size, filetype, seed=1)
+    return size * len(FILE_TYPES)
+
+
+def _test(autobp):
+    test = autobp.generate_test()
+    test.generate_components()
+    test.save()
+
+
+def _live(conf, optimize):
+    from bpauto import AutoBP, SECTIONS
+    from live import TclSession
+    with TclSession(stub=True, output=None) as session:
+        autobp = AutoBP(conf, optimize=optimize, session=session)
+        for section in SECTIONS:
+            autobp.generate_section(section)
+
+
+def run_point(conf, optimize=False, live=False):
+    """Run the pipeline on conf, returning the measurements of every stage."""
+    from bpauto import AutoBP
+
+    stages = Stages()
+    with TemporaryDirectory() as directory:
+        stages.run('config', _load, conf, directory)
+        stages.run('payloads', _payloads, conf, directory)
+    if live:
+        # Generation and execution in the stub Tcl shell, overlapped
+        stages.run('live', _live, conf, optimize)
+
+    autobp = stages.autobp = AutoBP(conf, optimize=optimize)
+    autobp.tfiles.take()
+    network = stages.run('network plan', autobp.generate_network)
+    for name, func, key in (('interfaces', network.generate_interfaces, 'Interfaces'),
+                            ('vlans', network.generate_vlans, 'VLANs'),
+                            ('ip routers', network.generate_ip_routers, 'IP Routers'),
+                            ('hosts', network.generate_hosts, 'IP Static Hosts')):
+        if key in conf['Network']:
+            stages.run(name, func)
+    stages.run('network save', network.save)
+    stages.run('superflows', autobp.generate_superflows)
+    stages.run('app profiles', autobp.generate_app_profiles)
+    stages.run('test', _test, autobp)
+    stages.run('teardown', autobp.teardown)
+    return stages.results
+
+
+def import_check(runs=5, budget_ms=IMPORT_BUDGET_MS):
+    """Time importing bpauto in fresh interpreters, raising AssertionError if it is over budget."""
+    seconds = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE] + list(DEFERRED_MODULES),
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        timing, modules = output.split('\n')[:2]
+        seconds.append(float(timing))
+        loaded.update(modules.split())
+    result = {'milliseconds': round(min(seconds) * 1000, 1), 'budget_ms': budget_ms, 'loaded': sorted(loaded)}
+    if loaded:
+        raise AssertionError('importing bpauto loads ' + ', '.join(sorted(loaded)))
+    if result['milliseconds'] > budget_ms:
+        raise AssertionError('importing bpauto takes {0} ms, over the {1} ms budget'.format(
+                             result['milliseconds'], budget_ms))
+    return result
+
+
+def run_axis(axis, values, optimize=False, live=False):
+    points = []
+    for value in values:
+        params = dict(BASE, **{axis: value})
+        # A fresh process per point keeps peak RSS from leaking between points
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            stages = pool.submit(run_point, synthetic_config(**params), optimize, live).result()
+        total = sum(stage['seconds'] for stage in stages.values())
+        print('{0:>10} = {1:<10} {2:8.3f} s {3:8d} kB'.format(
+              axis, value, total, max(stage['peak_rss_kb'] for stage in stages.values())))
+        points.append({'value': value, 'params': params, 'stages': stages})
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bpauto on synthetic configs.')
+    parser.add_argument('-a', '--axis', action='append', choices=sorted(AXES),
+               help='Axis to scale, may be repeated (default: all).')
+    parser.add_argument('-q', '--quick', action='store_true',
+               help='Only run the two smallest points of every axis.')
+    parser.add_argument('-O', '--optimize', action='store_true',
+               help='Benchmark with configure merging and TCL loops enabled.')
+    parser.add_argument('-L', '--live', action='store_true',
+               help='Also time a live session against the stub Tcl shell (needs tclsh).')
+    parser.add_argument('-i', '--imports', action='store_true',
+               help='Only check the import-time budget of bpauto.')
+    parser.add_argument('-o', '--output', default='bench.json',
+               help='JSON file the results are written to.')
+    args = parser.parse_args()
+
+    try:
+        imports = import_check()
+    except AssertionError as e:
+        sys.exit('import check failed: {0}'.format(e))
+    print('import bpauto {0} ms (budget {1} ms)'.format(imports['milliseconds'], imports['budget_ms']))
+    if args.imports:
+        return
+
+    axes = QUICK_AXES if args.quick else AXES
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'optimize': args.optimize,
+               'live': args.live,
+               'imports': imports,
+               'axes': {}}
+    for axis in args.axis or sorted(axes):
+        results['axes'][axis] = run_axis(axis, axes[axis], args.optimize, args.live)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print('Results written to ' + args.output, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,22 +2,168 @@
 """Library for generating BreakingPoint TCL commands."""
 
 from io import StringIO
-import yaml
-from itertools import cycle
-import importlib
+from shutil import copyfileobj
+from array import array
+import hashlib
+import json
+from itertools import cycle, groupby, islice
+from collections import Counter
+from superflow import SuperFlow
+import metrics
+
+class Configure(object):
+    """A pending `configure` command on a single TCL object."""
+    __slots__ = ('target', 'options')
+
+    def __init__(self, target):
+        self.target = target
+        self.options = {}
+
+    def set(self, option, value):
+        # Re-setting an option keeps its position, the last value wins
+        self.options[option] = value
+
+    def render(self):
+        return ' '.join(['{0} configure'.format(self.target)] +
+                        ['{0} {1}'.format(option, value) for option, value in self.options.items()])
+
 
 class TCLFiles(object):
-    def __init__(self):
-        self._createbuf = StringIO()
-        self._deletebuf = StringIO()
+    """Create/delete TCL script buffers.
+
+    With stream=True create commands go straight to <prefix>create.tcl as they
+    are emitted and delete commands are spilled to a temporary file, so nothing
+    is held in memory and partial output is on disk if generation fails.
+
+    With optimize=True consecutive configure calls on the same object are
+    folded into one multi-option configure command and repeated commands are
+    emitted as a TCL for loop.
+
+    With state set (the object hashes of a previous run, possibly empty) the
+    create commands of every object are collected between begin_unit and
+    end_unit and only written out when they differ from the previous run.
+    Objects missing from this run are deleted in the create script.
+
+    With session set (a live.TclSession) create commands are executed by a
+    Tcl shell as they are emitted instead of being written to create.tcl.
+
+    Objects created through these buffers are recorded in teardown, which
+    the delete script is generated from.
+    """
+    # Order in which objects of a kind can be deleted
+    KINDS = ('test', 'network', 'appprofile', 'superflow', 'payload')
+
+    def __init__(self, prefix=None, stream=False, optimize=False, state=None, session=None):
+        self._stream = stream
+        self._session = session
+        self.optimize = optimize
+        self._pending = None
+        self._state = state
+        self._units = []
+        self.objects = {}
+        self.teardown = Teardown()
+        self._profiler = metrics.current()
+        if self._profiler is not None:
+            self._profiler.add_flush(self._flush)
+        if session is not None:
+            self._createbuf = session
+            self._deletebuf = StringIO()
+        elif stream:
+            from tempfile import TemporaryFile
+            self._createbuf = open(prefix + 'create.tcl', 'w')
+            self._deletebuf = TemporaryFile('w+')
+        else:
+            self._createbuf = StringIO()
+            self._deletebuf = StringIO()
 
-    def pcreate(self, command):
+    def _emit(self, command):
+        if self._profiler is not None:
+            self._profiler.command(command)
         print(command, file=self._createbuf)
 
+    def _flush(self):
+        if self._pending is not None:
+            self._emit(self._pending.render())
+            self._pending = None
+
+    def pcreate(self, command):
+        self._flush()
+        self._emit(command)
+
+    def pcreate_many(self, commands):
+        self._flush()
+        if self._profiler is not None:
+            commands = self._profiler.commands(commands)
+        self._createbuf.writelines(command + '\n' for command in commands)
+
+    def prepeat(self, command, count):
+        if self.optimize and count > 1:
+            self.pcreate('for {{set i 0}} {{$i < {COUNT}}} {{incr i}} {{ {COMMAND} }}'.format(COUNT=count, COMMAND=command))
+        else:
+            for _ in range(count):
+                self.pcreate(command)
+
+    def pconfigure(self, target, option, value):
+        if self._pending is None or self._pending.target != target:
+            self._flush()
+            self._pending = Configure(target)
+        self._pending.set(option, value)
+        if not self.optimize:
+            self._flush()
+
     def pdelete(self, command):
+        if self._profiler is not None:
+            self._profiler.command(command, delete=True)
         print(command, file=self._deletebuf)
 
+    @property
+    def incremental(self):
+        return self._state is not None
+
+    def begin_unit(self, kind, name, delete):
+        if self._state is None:
+            return
+        self._flush()
+        self._units.append((kind + ':' + name, delete, self._createbuf))
+        self._createbuf = StringIO()
+
+    def end_unit(self):
+        if self._state is None:
+            return
+        self._flush()
+        key, delete, outer = self._units.pop()
+        text = self._createbuf.getvalue()
+        self._createbuf = outer
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        self.objects[key] = {'hash': digest, 'delete': delete}
+        if self._state.get(key, {}).get('hash') != digest:
+            # Objects created while another one is open (AUTOMATIC app profiles
+            # inside a test) go straight to the script, ahead of the enclosing one
+            root = self._units[0][2] if self._units else outer
+            root.write(text)
+
+    def take(self):
+        """Return the create and delete text emitted so far and start over."""
+        self._flush()
+        texts = self._createbuf.getvalue(), self._deletebuf.getvalue()
+        self._createbuf = StringIO()
+        self._deletebuf = StringIO()
+        return texts
+
+    def save_state(self, prefix):
+        with open(prefix + 'state.json', 'w') as statefile:
+            json.dump(self.objects, statefile, indent=2, sort_keys=True)
+
     def save_create(self, prefix):
+        self._flush()
+        if self._state is not None:
+            removed = sorted((key for key in self._state if key not in self.objects),
+                             key=lambda key: self.KINDS.index(key.split(':', 1)[0]))
+            for key in removed:
+                self.pcreate(self._state[key]['delete'])
+        if self._stream or self._session is not None:
+            self._createbuf.close()
+            return
         filename = prefix + 'create.tcl'
         with open(filename, 'w') as createfile:
             createfile.write(self._createbuf.getvalue())
@@ -25,17 +171,228 @@ class TCLFiles(object):
     def save_delete(self, prefix):
         filename = prefix + 'delete.tcl'
         with open(filename, 'w') as createfile:
-            createfile.write(self._deletebuf.getvalue())
+            if self._stream:
+                # Delete commands are emitted in execution order, copy the spill file as is
+                self._deletebuf.seek(0)
+                copyfileobj(self._deletebuf, createfile)
+                self._deletebuf.close()
+            else:
+                createfile.write(self._deletebuf.getvalue())
+
+
+class Teardown(object):
+    """The objects of a run and the objects each of them uses.
+
+    Deletes are ordered so that nothing is deleted while an object using it
+    still exists. Objects freed at the same time are deleted as one batch;
+    with optimize=True the deletes of one kind in a batch become a single
+    foreach loop. Payload files have no Tcl delete; they are recorded so
+    that whoever removes them from the tester knows when it is safe to.
+    """
+    COMMANDS = {
+        'test': '$bps deleteTest',
+        'network': '$bps deleteNeighborhood',
+        'appprofile': '$bps deleteAppProfile',
+        'superflow': '$bps deleteSuperflow',
+    }
+
+    def __init__(self):
+        # (kind, name) -> set of (kind, name) it uses, in creation order
+        self._uses = {}
+
+    def add(self, kind, name):
+        self._uses.setdefault((kind, name), set())
+
+    def use(self, user, kind, name):
+        self._uses.setdefault(user, set()).add((kind, name))
+
+    def update(self, other):
+        for node, uses in other._uses.items():
+            self._uses.setdefault(node, set()).update(uses)
+
+    def __iter__(self):
+        return iter(self._uses)
+
+    def select(self, nodes):
+        """A Teardown of only the objects in nodes."""
+        teardown = Teardown()
+        teardown._uses = {node: set(uses) for node, uses in self._uses.items() if node in nodes}
+        return teardown
+
+    def batches(self):
+        """Lists of objects that can be deleted together, in delete order."""
+        # Uses of objects this run did not create do not hold anything back
+        users = dict.fromkeys(self._uses, 0)
+        for uses in self._uses.values():
+            for node in uses:
+                if node in users:
+                    users[node] += 1
+        order = {node: index for index, node in enumerate(self._uses)}
+        batch = [node for node, count in users.items() if count == 0]
+        while batch:
+            batch.sort(key=lambda node: (TCLFiles.KINDS.index(node[0]), order[node]))
+            yield batch
+            freed = []
+            for user in batch:
+                for node in self._uses[user]:
+                    if node in users:
+                        users[node] -= 1
+                        if users[node] == 0:
+                            freed.append(node)
+            batch = freed
+
+    def commands(self, optimize=False):
+        for batch in self.batches():
+            yield from self.batch_commands(batch, optimize)
+
+    @classmethod
+    def batch_commands(cls, batch, optimize=False):
+        """Tcl deletes of one batch, payload files left out."""
+        for kind, nodes in groupby(batch, key=lambda node: node[0]):
+            if kind not in cls.COMMANDS:
+                continue
+            names = [name for _, name in nodes]
+            if optimize and len(names) > 1:
+                yield 'foreach name {{{0}}} {{ {1} $name }}'.format(
+                      ' '.join('"{0}"'.format(name) for name in names), cls.COMMANDS[kind])
+            else:
+                for name in names:
+                    yield '{0} "{1}"'.format(cls.COMMANDS[kind], name)
+
+
+class NameTable(object):
+    """Interns element names as small integer ids shared by the indexes of a network."""
+    __slots__ = ('_ids', 'names')
+
+    def __init__(self):
+        self._ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        return self._ids.get(name)
+
+    def intern(self, name):
+        ident = self._ids.get(name)
+        if ident is None:
+            ident = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return ident
+
+
+class PathIndex(object):
+    """Unordered-pair index of network paths, stored as packed pairs of name ids."""
+    def __init__(self, table=None):
+        self._table = table if table is not None else NameTable()
+        self._pairs = set()
+        self._peers = {}
+
+    def __len__(self):
+        return len(self._pairs)
+
+    @staticmethod
+    def _key(first, second):
+        return first << 32 | second if first < second else second << 32 | first
+
+    def __contains__(self, pair):
+        first, second = (self._table.get(name) for name in pair)
+        if first is None or second is None:
+            return False
+        return self._key(first, second) in self._pairs
+
+    def add(self, clientid, serverid):
+        first = self._table.intern(clientid)
+        second = self._table.intern(serverid)
+        key = self._key(first, second)
+        if key in self._pairs:
+            return False
+        self._pairs.add(key)
+        self._add_peer(first, second)
+        if first != second:
+            self._add_peer(second, first)
+        return True
+
+    def _add_peer(self, ident, peer):
+        # Most hosts have a single peer, kept as a bare id until a second one shows up
+        peers = self._peers.get(ident)
+        if peers is None:
+            self._peers[ident] = peer
+        elif isinstance(peers, int):
+            self._peers[ident] = array('I', (peers, peer))
+        else:
+            peers.append(peer)
+
+    def peers(self, hostid):
+        names = self._table.names
+        peers = self._peers.get(self._table.get(hostid), ())
+        if isinstance(peers, int):
+            peers = (peers,)
+        return {names[ident] for ident in peers}
+
+
+class PrefixIndex(object):
+    """Character trie of interned names for prefix lookups.
+
+    Every node holds the ids of the names below it in insertion order, a bare
+    int while there is only one. A node with a single name and no children
+    stands for the rest of that name and is only split when a second name
+    passes through it, so the unique tails of names take no nodes. Adding a
+    name costs its length and a lookup the prefix length plus the matches.
+    """
+    def __init__(self, table=None):
+        self._table = table if table is not None else NameTable()
+        # Nodes are [children or None, ids]
+        self._root = [{}, array('I')]
+
+    def __len__(self):
+        return len(self._root[1])
+
+    def add(self, name):
+        nameid = self._table.intern(name)
+        names = self._table.names
+        node = self._root
+        node[1].append(nameid)
+        for depth, char in enumerate(name, 1):
+            child = node[0].get(char)
+            if child is None:
+                node[0][char] = [None, nameid]
+                return
+            if child[0] is None:
+                # Split the leaf one level before a second name goes through it
+                other = names[child[1]]
+                child[0] = {other[depth]: [None, child[1]]} if len(other) > depth else {}
+            ids = child[1]
+            if isinstance(ids, int):
+                child[1] = array('I', (ids, nameid))
+            else:
+                ids.append(nameid)
+            node = child
+
+    def find(self, prefix):
+        names = self._table.names
+        node = self._root
+        for char in prefix:
+            if node[0] is None:
+                name = names[node[1]]
+                return iter((name,) if name.startswith(prefix) else ())
+            node = node[0].get(char)
+            if node is None:
+                return iter(())
+        ids = node[1]
+        if isinstance(ids, int):
+            return iter((names[ids],))
+        # Bound the iterator so names added while it is consumed are not picked up
+        return map(names.__getitem__, islice(ids, len(ids)))
 
 
 class BreakingPoint(object):
-    def __init__(self, *, prefix=None):
+    def __init__(self, *, prefix=None, stream=False, optimize=False, state=None, session=None):
         self._prefix = prefix
-        self.tfiles = TCLFiles()
+        self.tfiles = TCLFiles(prefix, stream, optimize, state, session)
         self._network = None
         self._test = None
-        self._superflows = []
-        self._app_profiles = []
 
     def connect(self, *, hostname=None, login='admin', password='admin'):
         command = ('set bps [bps::connect "{HOSTNAME}" "{LOGIN}" "{PASSWORD}" '
@@ -43,87 +400,95 @@ class BreakingPoint(object):
         self.tfiles.pcreate(command.format(HOSTNAME=hostname, LOGIN=login, PASSWORD=password))
         self.tfiles.pdelete(command.format(HOSTNAME=hostname, LOGIN=login, PASSWORD=password))
 
+    def delete_all(self):
+        """Emit the deletes of every object created so far, users before what they use."""
+        for command in self.tfiles.teardown.commands(self.tfiles.optimize):
+            self.tfiles.pdelete(command)
+
+    def delete_batch(self, batch):
+        """Emit the deletes of one batch of Teardown.batches()."""
+        for command in self.tfiles.teardown.batch_commands(batch, self.tfiles.optimize):
+            self.tfiles.pdelete(command)
+
     def save(self):
         self.tfiles.save_create(self._prefix)
         self.tfiles.save_delete(self._prefix)
+        if self.tfiles.incremental:
+            self.tfiles.save_state(self._prefix)
 
     def create_network(self, name='NN'):
+        self.tfiles.begin_unit('network', name, '$bps deleteNeighborhood "{0}"'.format(name))
         command = ('set n [$bps createNetwork -name "{NAME}"]')
         self.tfiles.pcreate(command.format(NAME=name))
+        self.tfiles.teardown.add('network', name)
         self._network = Network(self.tfiles, name)
         command = ('$n begin')
         self.tfiles.pcreate(command)
         return self._network
 
     def create_test(self, name):
+        self.tfiles.begin_unit('test', name, '$bps deleteTest "{0}"'.format(name))
         command = ('set test [$bps createTest -name "{NAME}"]')
         self.tfiles.pcreate(command.format(NAME=name))
+        self.tfiles.teardown.add('test', name)
         self._test = Test(self.tfiles, name)
         return self._test
 
     def create_superflow(self, name, app):
+        self.tfiles.begin_unit('superflow', name, '$bps deleteSuperflow "{0}"'.format(name))
         command = ('set superflow [$bps createSuperflow -template {TMPL} -name "{NAME}"]')
         self.tfiles.pcreate(command.format(NAME=name, TMPL='TMPL_' + app))
-#        sf = Superflow(self.tfiles, self._prefix + name, app)
-#        sf = globals()[app](self.tfiles, name, app)
-        m = importlib.import_module('superflow')
-        c = getattr(m, app)
-        sf = c(self.tfiles, name, app)
-        self._superflows.append(sf)
-        return sf
-
-    def delete_superflows(self):
-        for superflow in self._superflows:
-            command = '$bps deleteSuperflow "{NAME}"'
-            self.tfiles.pdelete(command.format(NAME=superflow.name))
-    
+        self.tfiles.teardown.add('superflow', name)
+        return SuperFlow(self.tfiles, name, app)
+
     def create_app_profile(self, name):
+        self.tfiles.begin_unit('appprofile', name, '$bps deleteAppProfile "{0}"'.format(name))
         command = ('set appprofile [$bps createAppProfile -name "{NAME}"]')
         self.tfiles.pcreate(command.format(NAME=name))
-        ap = AppProfile(self.tfiles, name)
-        self._app_profiles.append(ap)
-        return ap
-
-    def delete_app_profiles(self):
-        for app_profile in self._app_profiles:
-            command = '$bps deleteAppProfile "{NAME}"'
-            self.tfiles.pdelete(command.format(NAME=app_profile.name))
+        self.tfiles.teardown.add('appprofile', name)
+        return AppProfile(self.tfiles, name)
 
 
 class Test(object):
+    # Options naming another object the test uses, by kind
+    USES = {'-neighborhood': 'network'}
+
     def __init__(self, tfiles, name):
         self._name = name
         self.tfiles = tfiles
         self._components = []
 
     def configure(self, option, value):
-        command = ('$test configure {OPTION} {VALUE}')
-        self.tfiles.pcreate(command.format(OPTION=option, VALUE=value))
+        if option in self.USES:
+            self.tfiles.teardown.use(('test', self._name), self.USES[option], value.strip('"'))
+        self.tfiles.pconfigure('$test', option, value)
 
     def create_component(self, comp_type, name):
         command = ('set comp [$test createComponent {COMP_TYPE} "{NAME}" 1 2]')
         self.tfiles.pcreate(command.format(COMP_TYPE=comp_type, NAME=name))
-        comp = Component(self.tfiles, name)
+        comp = Component(self.tfiles, name, self._name)
         self._components.append(comp)
         return comp
 
     def save(self):
         command = ('$test save -force')
         self.tfiles.pcreate(command)
-
-    def delete(self):
-        command = ('$bps deleteTest "{NAME}"')
-        self.tfiles.pdelete(command.format(NAME=self._name))
+        self.tfiles.end_unit()
 
 
 class Component(object):
-    def __init__(self, tfiles, name):
+    # Options naming another object the component's test uses, by kind
+    USES = {'-profile': 'appprofile'}
+
+    def __init__(self, tfiles, name, test):
         self._name = name
+        self._test = test
         self.tfiles = tfiles
 
     def configure(self, option, value):
-        command = ('$comp configure {OPTION} {VALUE}')
-        self.tfiles.pcreate(command.format(OPTION=option, VALUE=value))
+        if option in self.USES:
+            self.tfiles.teardown.use(('test', self._test), self.USES[option], value.strip('"'))
+        self.tfiles.pconfigure('$comp', option, value)
 
 
 class AppProfile(object):
@@ -131,110 +496,184 @@ class AppProfile(object):
         self.name = name
         self.tfiles = tfiles
     def configure(self, weight_type):
-        command = ('$appprofile configure -weightType {WEIGHT_TYPE}')
-        self.tfiles.pcreate(command.format(WEIGHT_TYPE=weight_type))
+        self.tfiles.pconfigure('$appprofile', '-weightType', weight_type)
     def add_superflow(self, name, weight):
+        self.tfiles.teardown.use(('appprofile', self.name), 'superflow', name)
         command = ('$appprofile addSuperflow "{NAME}" {WEIGHT}')
         self.tfiles.pcreate(command.format(NAME=name, WEIGHT=weight))
     def save(self):
         command = ('$appprofile save -force')
         self.tfiles.pcreate(command)
+        self.tfiles.end_unit()
 
 
 class Network(object):
+    """A neighborhood under construction.
+
+    Element names are interned once in a NameTable; the prefix and path
+    indexes only hold their integer ids. Blocks of elements are passed as
+    parallel columns and rendered to TCL in one pass without keeping
+    per-element objects around.
+    """
+    INTERFACE = '$n add interface -number %s -id "%s" -mac_address "%s" -duplicate_mac_address %d'
+    VLAN = '$n add vlan -id %s -default_container "%s" -inner_vlan %s -mac_address "%s" -duplicate_mac_address 1'
+    IP_ROUTER = ('$n add ip_router -id "%s" -default_container "%s" -ip_address "%s" '
+                 '-gateway_ip_address "%s" -netmask %s')
+    IP_STATIC_HOSTS = ('$n add ip_static_hosts -id "%s" -tags [list "%s" "%s"] '
+                       '-default_container "%s" -ip_address "%s" -count %s -netmask %s')
+    GATEWAY = ' -gateway_ip_address "%s"'
+    PATH = '$n addPath "%s" "%s"'
+
     def __init__(self, tfiles, name):
         self._name = name
         self.tfiles = tfiles
-        self._interfaces = []
-        self._containers = []
-        self._ip_static_hosts = []
-        self._paths = []
+        self._names = NameTable()
+        self._interfaces = PrefixIndex(self._names)
+        self._containers = PrefixIndex(self._names)
+        self._ip_static_hosts = PrefixIndex(self._names)
+        self._host_tags = {}
+        self._paths = PathIndex(self._names)
+        self._tag_paths = Counter()
+        self._ip_proc = False
 
     def add_interface(self, name, number, mac_address, duplicate_mac_address=False):
-        if duplicate_mac_address:
-            duplicate_mac_address = 1
-        else:
-            duplicate_mac_address = 0
-        command = '$n add interface -number {NUMBER} -id "{ID}" -mac_address "{MAC}" -duplicate_mac_address {DMA}'
-        self.tfiles.pcreate(command.format(NUMBER=number,
-                                           ID=name,
-                                           MAC=mac_address,
-                                           DMA=duplicate_mac_address))
-        self._interfaces.append(name)
-        self._containers.append(name)
+        self.add_interface_block([name], [number], [mac_address], duplicate_mac_address)
+
+    def add_interface_block(self, names, numbers, mac_addresses, duplicate_mac_address=False):
+        duplicate_mac_address = 1 if duplicate_mac_address else 0
+        for name in names:
+            self._interfaces.add(name)
+            self._containers.add(name)
+        self.tfiles.pcreate_many(self.INTERFACE % (number, name, mac, duplicate_mac_address)
+                                 for name, number, mac in zip(names, numbers, mac_addresses))
 
     def add_vlan(self, name, container, vlan, mac_address):
-        command = '$n add vlan -id {ID} -default_container "{CONTAINER}" -inner_vlan {VLAN} -mac_address "{MAC}" -duplicate_mac_address 1'
-        self.tfiles.pcreate(command.format(ID=name, CONTAINER=container, VLAN=vlan, MAC=mac_address))
-        self._containers.append(name)
+        self.add_vlan_block([name], [container], [vlan], [mac_address])
+
+    def add_vlan_block(self, names, containers, vlans, mac_addresses):
+        for name in names:
+            self._containers.add(name)
+        self.tfiles.pcreate_many(self.VLAN % row for row in zip(names, containers, vlans, mac_addresses))
 
     def add_ip_router(self, name, container, ip_address, gateway, netmask):
-        command = ('$n add ip_router -id "{NAME}" '
-                   '-default_container "{CONTAINER}" -ip_address "{IP}" '
-                   '-gateway_ip_address "{GATEWAY}" -netmask {NETMASK}')
-        self.tfiles.pcreate(command.format(NAME=name,
-                                           CONTAINER=container,
-                                           IP=ip_address,
-                                           NETMASK=netmask,
-                                           GATEWAY=gateway))
-        self._containers.append(name)
+        self.add_ip_router_block([name], [container], [ip_address], [gateway], netmask)
+
+    def add_ip_router_block(self, names, containers, ip_addresses, gateways, netmask):
+        for name in names:
+            self._containers.add(name)
+        self.tfiles.pcreate_many(self.IP_ROUTER % (name, container, ip, gateway, netmask)
+                                 for name, container, ip, gateway in zip(names, containers, ip_addresses, gateways))
 
     def add_ip_static_hosts(self, name, tag, container, ip_address, count, netmask, gateway):
-        if gateway is not None:
-            command = ('$n add ip_static_hosts -id "{NAME}" '
-                       '-tags [list "{NAME}" "{TAG}"] '
-                       '-default_container "{CONTAINER}" -ip_address "{IP}" '
-                       '-count {COUNT} -netmask {NETMASK} '
-                       '-gateway_ip_address "{GATEWAY}"')
-            self.tfiles.pcreate(command.format(NAME=name,
-                                               TAG=tag,
-                                               CONTAINER=container,
-                                               IP=ip_address,
-                                               COUNT=count,
-                                               NETMASK=netmask,
-                                               GATEWAY=gateway))
+        self.add_ip_static_hosts_block([name], tag, [container], [ip_address], count, netmask, [gateway])
+
+    def add_ip_static_hosts_block(self, names, tag, containers, ip_addresses, count, netmask, gateways):
+        for name in names:
+            self._ip_static_hosts.add(name)
+            self._host_tags[name] = tag
+        self.tfiles.pcreate_many(
+            self.IP_STATIC_HOSTS % (name, name, tag, container, ip, count, netmask) +
+            (self.GATEWAY % gateway if gateway is not None else '')
+            for name, container, ip, gateway in zip(names, containers, ip_addresses, gateways))
+
+    def _loop_prelude(self, containers):
+        if not self._ip_proc:
+            self.tfiles.pcreate('proc bpauto_ip {value} {\n'
+                                '    format %d.%d.%d.%d [expr {($value >> 24) & 255}] [expr {($value >> 16) & 255}] '
+                                '[expr {($value >> 8) & 255}] [expr {$value & 255}]\n'
+                                '}')
+            self._ip_proc = True
+        self.tfiles.pcreate('set containers [list {0}]'.format(' '.join('"{0}"'.format(c) for c in containers)))
+
+    def add_ip_router_loop(self, prefix, containers, ip_start, gateway_start, step, count, netmask):
+        """Add prefix1..prefix<count> with addresses start + i * step as a single TCL loop."""
+        containers = list(containers)
+        self._loop_prelude(containers)
+        command = ('for {{set i 0}} {{$i < {COUNT}}} {{incr i}} {{\n'
+                   '    $n add ip_router -id "{NAME}[expr {{$i + 1}}]" '
+                   '-default_container [lindex $containers [expr {{$i % {CONTAINERS}}}]] '
+                   '-ip_address [bpauto_ip [expr {{{IP} + $i * {STEP}}}]] '
+                   '-gateway_ip_address [bpauto_ip [expr {{{GATEWAY} + $i * {STEP}}}]] -netmask {NETMASK}\n'
+                   '}}')
+        self.tfiles.pcreate(command.format(COUNT=count, NAME=prefix, CONTAINERS=len(containers),
+                                           IP=ip_start, GATEWAY=gateway_start, STEP=step, NETMASK=netmask))
+        for i in range(1, count + 1):
+            self._containers.add(prefix + str(i))
+
+    def add_ip_static_hosts_loop(self, prefix, tag, containers, ip_start, gateway_start, step, count, ip_count, netmask):
+        """Add prefix1..prefix<count> with addresses start + i * step as a single TCL loop."""
+        containers = list(containers)
+        self._loop_prelude(containers)
+        if gateway_start is not None:
+            gateway = ' -gateway_ip_address [bpauto_ip [expr {{{0} + $i * {1}}}]]'.format(gateway_start, step)
         else:
-            command = ('$n add ip_static_hosts -id "{NAME}" '
-                       '-tags [list "{NAME}" "{TAG}"] '
-                       '-default_container "{CONTAINER}" -ip_address "{IP}" '
-                       '-count {COUNT} -netmask {NETMASK}')
-            self.tfiles.pcreate(command.format(NAME=name,
-                                               TAG=tag,
-                                               CONTAINER=container,
-                                               IP=ip_address,
-                                               COUNT=count,
-                                               NETMASK=netmask))
-
-        self._ip_static_hosts.append(name)
+            gateway = ''
+        command = ('for {{set i 0}} {{$i < {COUNT}}} {{incr i}} {{\n'
+                   '    set id "{NAME}[expr {{$i + 1}}]"\n'
+                   '    $n add ip_static_hosts -id $id -tags [list $id "{TAG}"] '
+                   '-default_container [lindex $containers [expr {{$i % {CONTAINERS}}}]] '
+                   '-ip_address [bpauto_ip [expr {{{IP} + $i * {STEP}}}]] '
+                   '-count {IP_COUNT} -netmask {NETMASK}{GATEWAY}\n'
+                   '}}')
+        self.tfiles.pcreate(command.format(COUNT=count, NAME=prefix, TAG=tag, CONTAINERS=len(containers),
+                                           IP=ip_start, STEP=step, IP_COUNT=ip_count, NETMASK=netmask,
+                                           GATEWAY=gateway))
+        for i in range(1, count + 1):
+            name = prefix + str(i)
+            self._ip_static_hosts.add(name)
+            self._host_tags[name] = tag
 
     def get_interface_group(self, prefix):
-        return [i for i in self._interfaces if (i.startswith(prefix))]
+        return self._interfaces.find(prefix)
 
     def get_container_group(self, prefix):
-        return [i for i in self._containers if (i.startswith(prefix))]
+        return self._containers.find(prefix)
 
     def get_ip_static_hosts_group(self, prefix):
-        return [i for i in self._ip_static_hosts if (i.startswith(prefix))]
+        return self._ip_static_hosts.find(prefix)
+
+    def _record_path(self, clientid, serverid):
+        if not self._paths.add(clientid, serverid):
+            return False
+        for tag in {clientid, serverid,
+                    self._host_tags.get(clientid, clientid), self._host_tags.get(serverid, serverid)}:
+            self._tag_paths[tag] += 1
+        return True
 
     def add_path(self, clientid, serverid):
-        command = '$n addPath "{CLI_ID}" "{SER_ID}"'
-        self.tfiles.pcreate(command.format(CLI_ID=clientid, SER_ID=serverid))
-        self._paths.append({clientid, serverid})
+        if not self._record_path(clientid, serverid):
+            return False
+        self.tfiles.pcreate(self.PATH % (clientid, serverid))
+        return True
+
+    def add_paths(self, names, peernames):
+        """Pair two host groups, cycling the shorter one. Existing paths are skipped."""
+        names = list(names)
+        peernames = list(peernames)
+        if len(names) > len(peernames):
+            peernames = cycle(peernames)
+        elif len(peernames) > len(names):
+            names = cycle(names)
+        before = len(self._paths)
+        self.tfiles.pcreate_many(self.PATH % pair for pair in zip(names, peernames) if self._record_path(*pair))
+        return len(self._paths) - before
 
     def path_exists(self, clientid, serverid):
-        if {clientid, serverid} in self._paths:
-            return True
-        else:
-            return False
+        return (clientid, serverid) in self._paths
+
+    def get_path_peers(self, hostid):
+        return self._paths.peers(hostid)
+
+    def path_count(self, tag=None):
+        if tag is None:
+            return len(self._paths)
+        return self._tag_paths[tag]
 
     def save(self):
         command = ('$n commit\n'
                    '$n save -name "{NAME}" -force')
         self.tfiles.pcreate(command.format(NAME=self._name))
-
-    def delete(self):
-        command = ('$bps deleteNeighborhood "{NAME}"')
-        self.tfiles.pdelete(command.format(NAME=self._name))
+        self.tfiles.end_unit()
 
 
 
@@ -2,14 +2,59 @@
 """Library for generating BreakingPoint TCL commands."""
 
 from io import StringIO
-import yaml
 from itertools import cycle
 from bp import BreakingPoint
 import argparse
-from pykwalify.core import Core
-from ipaddress import IPv4Address
-from payload import PayloadFile
-from copy import deepcopy
+import json
+import os
+import shlex
+import sys
+import time
+from netplan import NetworkPlan, ipv4_step
+from config import load_config
+from payload import PayloadFile, PayloadUploader, delete_command
+from fractions import Fraction
+from superflow import register_applications
+from metrics import stage
+
+# Step ramp of every component: starts at RAMP_MIN sessions/s and grows every RAMP_INTERVAL seconds
+RAMP_MIN = 1
+RAMP_INTERVAL = 1
+
+# Sections in the order they are created on the tester
+SECTIONS = ('Network', 'Super Flows', 'Application Profiles', 'Test')
+
+
+def largest_remainder(total, weights):
+    """Split an integer total proportionally to weights so the parts sum to total exactly."""
+    weights = [Fraction(weight) for weight in weights]
+    weight_sum = sum(weights)
+    quotas = [total * weight / weight_sum for weight in weights]
+    parts = [int(quota) for quota in quotas]
+    remainders = sorted(range(len(weights)), key=lambda i: quotas[i] - parts[i], reverse=True)
+    for i in remainders[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def ramp_increment(rate, ramp_up):
+    """Sessions/s added per ramp interval so a component ramps up to rate."""
+    return max(1, round(rate / ramp_up))
+
+
+def allocate_rates(total, weights):
+    """Split total like largest_remainder, but give every positive weight at least 1."""
+    positive = sum(1 for weight in weights if weight > 0)
+    if total < positive:
+        raise ValueError('{0} is too small to give each of {1} weights a rate of at least 1'.format(total, positive))
+    parts = largest_remainder(total, weights)
+    for i, weight in enumerate(weights):
+        if weight > 0 and parts[i] == 0:
+            # Take it from the largest share, which loses the least in proportion
+            parts[parts.index(max(parts))] -= 1
+            parts[i] = 1
+    return parts
+
 
 class AutoTest(object):
 
@@ -18,6 +63,7 @@ class AutoTest(object):
         self._bps = bps
         self._test_conf = test_conf
         self._app_profile_conf = app_profile_conf
+        self._flow_profiles = set()
         self._test = self._bps.create_test(name=self._prefix + test_conf['Name'])
         self._test.configure('-neighborhood', '"{0}"'.format(self._prefix + test_conf['Network']))
 
@@ -32,12 +78,12 @@ class AutoTest(object):
         comp.configure('-rampDist.down', comp_conf['Ramp Down Duration'])
         comp.configure('-rampDist.downBehavior', 'full')
         comp.configure('-rampUpProfile.max', comp_conf['Max Sessions per sec'])
-        comp.configure('-rampUpProfile.interval', '1')
-        comp.configure('-rampUpProfile.min', '1')
+        comp.configure('-rampUpProfile.interval', RAMP_INTERVAL)
+        comp.configure('-rampUpProfile.min', RAMP_MIN)
         comp.configure('-rampUpProfile.type', 'step')
         comp.configure('-rateDist.scope', 'per_if')
-        increment = max(1, round(comp_conf['Max Sessions per sec']/comp_conf['Ramp Up Duration']))
-        comp.configure('-rampUpProfile.increment', increment)
+        comp.configure('-rampUpProfile.increment', ramp_increment(comp_conf['Max Sessions per sec'],
+                                                                  comp_conf['Ramp Up Duration']))
         comp.configure('-sessions.max', comp_conf['Max Sessions'])
         comp.configure('-sessions.maxPerSecond', comp_conf['Max Sessions per sec'])
         comp.configure('-tcp.retries', '7')
@@ -46,151 +92,181 @@ class AutoTest(object):
         comp.configure('-client_tags', comp_conf['Client Tags'])
         comp.configure('-server_tags', comp_conf['Server Tags'])
 
+    def _flow_profile(self, superflow):
+        """Create the single superflow app profile of AUTOMATIC components, once per run."""
+        if superflow in self._flow_profiles:
+            return
+        self._flow_profiles.add(superflow)
+        ap = self._bps.create_app_profile(self._prefix + superflow + ' ap')
+        ap.add_superflow(self._prefix + superflow, 100)
+        ap.save()
+
     def generate_components(self):
         for comp_conf in self._test_conf['Components']:
             if comp_conf['Name'] == 'AUTOMATIC':
                 profile = next(item for item in self._app_profile_conf if item['Name'] == comp_conf['Application Profile'])
-                comp_conf_cpy = deepcopy(comp_conf)
-                total_weight = sum(superflow['Weight'] for superflow in profile['Super Flows'])
-                for superflow in profile['Super Flows']:
-                    ap = self._bps.create_app_profile(self._prefix + superflow['Name'] + ' ap')
-                    ap.add_superflow(self._prefix + superflow['Name'], 100)
-                    ap.save()
-                    comp_conf_cpy['Name'] = superflow['Name']
-                    comp_conf_cpy['Application Profile'] = superflow['Name'] + ' ap'
-                    comp_conf_cpy['Max Sessions per sec'] = round((superflow['Weight']/total_weight)*comp_conf['Max Sessions per sec'])
-                    self._gen_comp(comp_conf_cpy)
+                rates = allocate_rates(comp_conf['Max Sessions per sec'],
+                                       [superflow['Weight'] for superflow in profile['Super Flows']])
+                for superflow, rate in zip(profile['Super Flows'], rates):
+                    with stage('app profile'):
+                        self._flow_profile(superflow['Name'])
+                    flow_conf = dict(comp_conf)
+                    flow_conf['Name'] = superflow['Name']
+                    flow_conf['Application Profile'] = superflow['Name'] + ' ap'
+                    flow_conf['Max Sessions per sec'] = rate
+                    with stage('component'):
+                        self._gen_comp(flow_conf)
             else:
-                self._gen_comp(comp_conf)
+                with stage('component'):
+                    self._gen_comp(comp_conf)
             
     def save(self):
         self._test.save()
 
-    def delete(self):
-        self._test.delete()
-
 
 class AutoNetwork(object):
 
     def __init__(self, prefix, net_conf, bps):
         self._net_conf = net_conf
+        with stage('plan'):
+            self._plan = NetworkPlan(net_conf)
         self._network = bps.create_network(name=prefix + net_conf["Name"])
-        self._mac = self._gen_mac()
 
     def save(self):
         self._network.save()
 
-    def delete(self):
-        self._network.delete()
-
-    def _gen_mac(self):
-        for i in range(197, 255):
-            for j in range(1, 255):
-                yield "02:1A:{:02x}:{:02x}:00:00".format(i, j)
-
-    def _gen_ip(self, ip_address, inc_mask):
-        ip = IPv4Address(ip_address)
-        inc = IPv4Address(inc_mask)
-        while True:
-            yield ip
-            ip = ip + int(inc)
+    def _compact(self, block_conf):
+        # Blocks are arithmetic runs by construction, emit them as one TCL loop when optimizing
+        return self._network.tfiles.optimize and block_conf['Count'] > 1
 
     def generate_interfaces(self):
-       def gen_int_num(start, inc):
-           for i in range(start, 255, inc):
-               yield i
-
-       def gen_int_name(prefix, start, inc):
-           for i in range(start, 255, inc):
-               yield prefix + str(i)
-
-       int_mac = self._mac
-       for interface in self._net_conf["Interfaces"]:
-           int_num = gen_int_num(interface["Start Number"], interface["Increment"])
-           int_name = gen_int_name(interface["Name"], interface["Start Number"], interface["Increment"])
-           for _ in range(interface["Count"]):
-               self._network.add_interface(name=next(int_name),
-                                           number=next(int_num),
-                                           mac_address=next(int_mac),
-                                           duplicate_mac_address=interface['Duplicate MAC address'])
+       for interface, plan in zip(self._net_conf["Interfaces"], self._plan.interfaces):
+           self._network.add_interface_block(plan['names'], plan['numbers'], plan['macs'],
+                                             duplicate_mac_address=interface['Duplicate MAC address'])
 
     def generate_vlans(self):
-        def gen_vlan_id(start, inc):
-            for i in range(start, 4096, inc):
-                yield i
-        
-        def gen_vlan_name(prefix, start, inc):
-           for i in range(start, 4096, inc):
-               yield prefix + str(i)
-
-        for vlan in self._net_conf['VLANs']:
-            vlan_name = gen_vlan_name(vlan['Name'], vlan['VLAN ID'], vlan['Increment'])
+        for vlan, plan in zip(self._net_conf['VLANs'], self._plan.vlans):
             container = cycle(self._network.get_container_group(vlan["Container"]))
-            vlanid = gen_vlan_id(vlan['VLAN ID'], vlan['Increment'])
-            vlan_mac = self._mac
-            for _ in range(vlan['Count']):
-                self._network.add_vlan(name=next(vlan_name), container=next(container), vlan=next(vlanid), mac_address=next(vlan_mac))
+            self._network.add_vlan_block(plan['names'], container, plan['ids'], plan['macs'])
 
     def generate_ip_routers(self):
-        def gen_ip_router_name(prefix):
-           for i in range(1, 1000):
-               yield prefix + str(i)
-
-        for ip_routers in self._net_conf['IP Routers']:
-            ip_address = self._gen_ip(ip_routers['IP Address'], ip_routers['Increment Mask'])
-            gw_address = self._gen_ip(ip_routers['Gateway'], ip_routers['Increment Mask'])
-            ip_router_name = gen_ip_router_name(ip_routers['Name'])
+        for ip_routers, plan in zip(self._net_conf['IP Routers'], self._plan.ip_routers):
+            if self._compact(ip_routers):
+                ip_start, step = ipv4_step(ip_routers['IP Address'], ip_routers['Increment Mask'])
+                gateway_start, _ = ipv4_step(ip_routers['Gateway'], ip_routers['Increment Mask'])
+                self._network.add_ip_router_loop(ip_routers['Name'],
+                                                 self._network.get_container_group(ip_routers["Container"]),
+                                                 ip_start, gateway_start, step, ip_routers['Count'],
+                                                 ip_routers['Netmask'])
+                continue
             container = cycle(self._network.get_container_group(ip_routers["Container"]))
-
-            for _ in range(ip_routers['Count']):
-                self._network.add_ip_router(name=next(ip_router_name), container=next(container),
-                                            ip_address=next(ip_address), gateway=next(gw_address),
-                                            netmask=ip_routers['Netmask'])
+            self._network.add_ip_router_block(plan['names'], container, plan['ips'], plan['gateways'],
+                                              ip_routers['Netmask'])
 
     def generate_hosts(self):
-        def gen_hosts_name(prefix):
-           for i in range(1, 1000):
-               yield prefix + str(i)
-
-        for hosts in self._net_conf['IP Static Hosts']:
-           ip_address = self._gen_ip(hosts['IP Address'], hosts['Increment Mask'])
-           if hosts['Gateway'] is not None:
-               gw_address = self._gen_ip(hosts['Gateway'], hosts['Increment Mask'])
-           else:
-               gw_address = cycle([None])
-           hosts_name = gen_hosts_name(hosts['Name'])
+        for hosts, plan in zip(self._net_conf['IP Static Hosts'], self._plan.ip_static_hosts):
            tag = hosts['Name']
+           if self._compact(hosts):
+               ip_start, step = ipv4_step(hosts['IP Address'], hosts['Increment Mask'])
+               gateway_start = None
+               if hosts['Gateway'] is not None:
+                   gateway_start, _ = ipv4_step(hosts['Gateway'], hosts['Increment Mask'])
+               self._network.add_ip_static_hosts_loop(hosts['Name'], tag,
+                                                      self._network.get_container_group(hosts["Container"]),
+                                                      ip_start, gateway_start, step, hosts['Count'],
+                                                      hosts['IP Count'], hosts['Netmask'])
+               continue
            container = cycle(self._network.get_container_group(hosts["Container"]))
+           self._network.add_ip_static_hosts_block(plan['names'], tag, container, plan['ips'],
+                                                   hosts['IP Count'], hosts['Netmask'], plan['gateways'])
 
-           for _ in range(hosts['Count']):
-               self._network.add_ip_static_hosts(name=next(hosts_name), tag=tag, container=next(container),
-                                           ip_address=next(ip_address), count=hosts['IP Count'], netmask=hosts['Netmask'],
-                                           gateway=next(gw_address))
-
-        for hosts in self._net_conf['IP Static Hosts']:
-            names = self._network.get_ip_static_hosts_group(hosts['Name'])
-            peernames = self._network.get_ip_static_hosts_group(hosts['Path'])
-            if len(names) > len(peernames):
-                peernames = cycle(peernames)
-            elif len(peernames) > len(names):
-                names = cycle(names)
-            for name, peer in zip(names, peernames):
-                if not self._network.path_exists(name, peer):
-                    self._network.add_path(name, peer)
-                
+        with stage('paths'):
+            for hosts in self._net_conf['IP Static Hosts']:
+                names = self._network.get_ip_static_hosts_group(hosts['Name'])
+                peernames = self._network.get_ip_static_hosts_group(hosts['Path'])
+                self._network.add_paths(names, peernames)
 
 
 
 class AutoBP(object):
 
-    def __init__(self, conf):
+    def __init__(self, conf, stream=False, optimize=False, state=None, connect=True, session=None, upload=True):
         self._conf = conf
+        self._upload = upload
+        # Names of the payload files the superflows use under /resources/
         self._conn_conf = conf['Connection']
         self._gen_conf = conf['General']
         self._prefix=self._gen_conf['Prefix']
 
-        self._bps = BreakingPoint(prefix=self._prefix)
-        self._bps.connect(hostname=self._conn_conf['Tester IP'], login=self._conn_conf['Login'], password=self._conn_conf['Password'])
+        self._bps = BreakingPoint(prefix=self._prefix, stream=stream, optimize=optimize, state=state,
+                                  session=session)
+        if connect:
+            self.connect()
+
+    def connect(self):
+        with stage('connect'):
+            self._bps.connect(hostname=self._conn_conf['Tester IP'], login=self._conn_conf['Login'], password=self._conn_conf['Password'])
+
+    def generate_section(self, section):
+        with stage(section):
+            self._generate_section(section)
+
+    def _generate_section(self, section):
+        if section == 'Network':
+            network = self.generate_network()
+            for key, name, generate in (('Interfaces', 'interfaces', network.generate_interfaces),
+                                        ('VLANs', 'vlans', network.generate_vlans),
+                                        ('IP Routers', 'ip routers', network.generate_ip_routers),
+                                        ('IP Static Hosts', 'hosts', network.generate_hosts)):
+                if key in self._conf['Network']:
+                    with stage(name):
+                        generate()
+            network.save()
+        elif section == 'Super Flows':
+            self.generate_superflows()
+        elif section == 'Application Profiles':
+            self.generate_app_profiles()
+        elif section == 'Test':
+            test = self.generate_test()
+            test.generate_components()
+            test.save()
+
+    def teardown(self, session=None):
+        """Emit the deletes of every object generated so far.
+
+        With session set the deletes are executed one batch at a time, and
+        payload files are removed from the tester in the batch after the
+        superflows using them are deleted.
+        """
+        with stage('teardown'):
+            if session is None:
+                self._bps.delete_all()
+                return
+            for batch in self.tfiles.teardown.batches():
+                self._bps.delete_batch(batch)
+                _, delete = self.tfiles.take()
+                if delete:
+                    session.writelines(delete.splitlines(True))
+                    session.wait()
+                self.delete_payloads([name for kind, name in batch if kind == 'payload'])
+
+    @property
+    def payload_files(self):
+        """Names of the payload files the superflows use, in creation order."""
+        return [name for kind, name in self.tfiles.teardown if kind == 'payload']
+
+    def delete_payloads(self, filenames):
+        """Remove filenames from the tester in one SSH command."""
+        if not filenames:
+            return
+        upload_conf = self._conf['FileUpload']
+        with stage('delete payloads'):
+            PayloadFile().delete_files(filenames, upload_conf['Tester IP'],
+                                       upload_conf['Login'], upload_conf['Password'])
+
+    @property
+    def tfiles(self):
+        return self._bps.tfiles
 
     def generate_network(self):
         self._net_conf = self._conf['Network']
@@ -204,23 +280,36 @@ class AutoBP(object):
         return self._test
 
     def generate_superflows(self):
-        payload = PayloadFile()
-        upload_conf = self._conf['FileUpload']
+        upload_conf = self._conf.get('FileUpload', {})
+        payload = PayloadFile(cache_dir=upload_conf.get('Cache Directory'))
+        uploader = None
+        # One upload per distinct payload, superflows with the same file share it
+        uploads = {}
         for superflow in self._conf['Super Flows']:
             sf = self._bps.create_superflow(self._prefix + superflow['Name'], superflow['Application'])
             if 'File Type' in superflow:
                 filename = self._gen_conf['Prefix'] + superflow['File Type'] + str(superflow['Transation Size'])
+                if superflow.get('Seed') is not None:
+                    filename += '_' + str(superflow['Seed'])
                 filename = filename.replace(" ", "_")
-                payload.generate_file(filename, superflow['Transation Size'], superflow['File Type'])
-                payload.upload_file(filename, upload_conf['Tester IP'], upload_conf['Login'], upload_conf['Password'])
-
                 sf.modify(tsize=superflow['Transation Size'], filename=filename)
+                if filename not in uploads:
+                    uploads[filename] = None
+                if self._upload and uploads[filename] is None:
+                    # Generated once, rewriting it could corrupt an upload still reading it
+                    localpath = payload.cached_file(filename, superflow['Transation Size'], superflow['File Type'],
+                                                    seed=superflow.get('Seed'))
+                    if uploader is None:
+                        uploader = PayloadUploader(payload, upload_conf['Tester IP'], upload_conf['Login'],
+                                                   upload_conf['Password'], workers=upload_conf.get('Workers', 4))
+                    uploads[filename] = uploader.submit(filename, localpath)
             elif 'Transation Size' in superflow:
                 sf.modify(tsize=superflow['Transation Size'])
             sf.save()
-
-    def delete_superflows(self):
-        self._bps.delete_superflows()
+        if uploader is not None:
+            uploader.close()
+            for upload in uploads.values():
+                upload.result()
 
     def generate_app_profiles(self):
         for app_profile in self._conf['Application Profiles']:
@@ -230,11 +319,17 @@ class AutoBP(object):
                 ap.add_superflow(self._gen_conf['Prefix'] + superflow['Name'], superflow['Weight'])
             ap.save()
 
-    def delete_app_profiles(self):
-        self._bps.delete_app_profiles()
-
     def save(self):
-        self._bps.save()
+        with stage('save'):
+            self._bps.save()
+
+
+def load_state(prefix):
+    try:
+        with open(prefix + 'state.json') as statefile:
+            return json.load(statefile)
+    except FileNotFoundError:
+        return {}
 
 
 def main():
@@ -249,14 +344,91 @@ def main():
                help='Tester management login username.')
     parser.add_argument('-p', '--password',
                help='Tester management password.')
+    parser.add_argument('-s', '--stream', action='store_true',
+               help='Write TCL scripts to disk while they are generated.')
+    parser.add_argument('-O', '--optimize', action='store_true',
+               help='Merge consecutive configure commands and compress repeated commands into loops.')
+    parser.add_argument('-I', '--incremental', action='store_true',
+               help='Only create objects that changed since the last run, tracked in <prefix>state.json.')
+    parser.add_argument('-j', '--jobs', type=int,
+               help='Worker processes for --parallel, Matrix variants or Shards (default: one per core).')
+    parser.add_argument('-P', '--parallel', action='store_true',
+               help='Compile network, superflows, app profiles and test in parallel processes.')
+    parser.add_argument('-L', '--live', action='store_true',
+               help='Execute the create commands in a Tcl shell while they are generated instead of writing create.tcl.')
+    parser.add_argument('--shell', default='tclsh',
+               help='Tcl shell command for --live (default: tclsh).')
+    parser.add_argument('--batch', type=int, default=100,
+               help='Lines sent to the --live shell at a time (default: 100).')
+    parser.add_argument('--stub', action='store_true',
+               help='Run --live against a local stub of the BreakingPoint TCL API.')
+    parser.add_argument('-T', '--teardown', action='store_true',
+               help='Delete what the config creates instead of creating it: write delete.tcl and print the command '
+                    'removing its payload files, or with --live run both in order.')
+    parser.add_argument('--plan', action='store_true',
+               help='Only check the offered load against line rate, Max Sessions and the ramp, see <prefix>plan.json.')
+    parser.add_argument('--line-rate', type=float, default=10,
+               help='Port line rate in Gbit/s for --plan (default: 10).')
+    parser.add_argument('--profile', action='store_true',
+               help='Print where the run spends its time and write it to <prefix>profile.json.')
+    parser.add_argument('--profile-memory', action='store_true',
+               help='Like --profile, also tracing peak memory per stage (slower).')
+    parser.add_argument('--no-validate', action='store_true',
+               help='Skip checking the configuration against schema.yaml.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+               help='Check how Shards split the config without writing scripts.')
+
+    parser.add_argument('-w', '--watch', action='store_true',
+               help='Keep running and regenerate the scripts whenever the configuration changes.')
 
     args = parser.parse_args()
+    if args.parallel and (args.stream or args.incremental):
+        parser.error('--parallel cannot be combined with --stream or --incremental')
+    if args.live and (args.parallel or args.stream):
+        parser.error('--live cannot be combined with --parallel or --stream')
+    if args.teardown and (args.parallel or args.stream or args.incremental):
+        parser.error('--teardown cannot be combined with --parallel, --stream or --incremental')
+
+    if args.watch:
+        watch(args)
+    else:
+        run(args)
+
+
+def watch(args, interval=0.2):
+    """Regenerate on every change of the config, keeping imports, schema and registries warm."""
+    last = None
+    while True:
+        try:
+            mtime = os.stat(args.config).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime != last:
+            last = mtime
+            start = time.perf_counter()
+            try:
+                run(args)
+            except Exception as e:
+                print('{0}: {1}'.format(args.config, e), file=sys.stderr)
+            else:
+                print('{0}: generated in {1:.0f} ms'.format(args.config, (time.perf_counter() - start) * 1000))
+        time.sleep(interval)
 
-#    c = Core(source_file=args.config, schema_files=["schema.yaml"])
-#    c.validate(raise_exception=True)
 
-    with open(args.config) as configfile:
-        conf = yaml.load(configfile)
+def run(args):
+    if not (args.profile or args.profile_memory):
+        run_config(args)
+        return
+    from metrics import Profiler
+    with Profiler(memory=args.profile_memory) as profiler:
+        conf = run_config(args)
+    print(profiler.report())
+    profiler.save(conf['General']['Prefix'] + 'profile.json')
+
+
+def run_config(args):
+    with stage('config'):
+        conf = load_config(args.config, validation=not args.no_validate)
 
     if args.tester_ip:
         conf['Connection']['Tester IP'] = args.tester_ip
@@ -265,38 +437,92 @@ def main():
     if args.password:
         conf['Connection']['Password'] = args.password
 
-    autobp = AutoBP(conf)
-    if 'Network' in conf:
-        network = autobp.generate_network()
-        if 'Interfaces' in conf['Network']:
-            network.generate_interfaces()
-        if 'VLANs' in conf['Network']:
-            network.generate_vlans()
-        if 'IP Routers' in conf['Network']:
-            network.generate_ip_routers()
-        if 'IP Static Hosts' in conf['Network']:
-            network.generate_hosts()
-        network.save()
-    if 'Super Flows' in conf:
-        autobp.generate_superflows()
-    if 'Application Profiles' in conf:
-        autobp.generate_app_profiles()
-    if 'Test' in conf:
-        test = autobp.generate_test()
-        test.generate_components()
-        test.save()
-
-    if 'Test' in conf:
-        test.delete()
-    if 'Network' in conf:
-        network.delete()
-    if 'Application Profiles' in conf:
-        autobp.delete_app_profiles()
-    if 'Super Flows' in conf:
-        autobp.delete_superflows()
-
+    register_applications(conf.get('Applications') or {})
+
+    state = None
+    if args.incremental:
+        state = load_state(conf['General']['Prefix'])
+
+    if args.plan:
+        from capacity import CapacityPlan
+        with stage('plan'):
+            plan = CapacityPlan(conf, line_rate=args.line_rate * 1e9)
+        print(plan.report())
+        plan.save(conf['General']['Prefix'] + 'plan.json')
+        return conf
+
+    if (args.live or args.teardown) and ('Shards' in conf or 'Matrix' in conf):
+        raise ValueError('--live and --teardown run a single config, not Shards or Matrix variants')
+
+    if args.teardown:
+        if args.live:
+            from live import TclSession
+            with TclSession(shell=shlex.split(args.shell), batch=args.batch, stub=args.stub) as session:
+                teardown(conf, args, session)
+        else:
+            teardown(conf, args)
+        return conf
+
+    if 'Shards' in conf:
+        from shard import run_shards
+        with stage('shards'):
+            run_shards(conf, optimize=args.optimize, jobs=args.jobs, dry_run=args.dry_run)
+        return conf
+
+    if 'Matrix' in conf:
+        from matrix import run_matrix
+        with stage('matrix'):
+            run_matrix(conf, optimize=args.optimize, jobs=args.jobs)
+        return conf
+
+    if args.parallel:
+        from matrix import compile_variants
+        with stage('parallel'):
+            compile_variants([('', conf)], optimize=args.optimize, jobs=args.jobs)
+        return conf
+
+    if args.live:
+        from live import TclSession
+        with TclSession(shell=shlex.split(args.shell), batch=args.batch, stub=args.stub) as session:
+            generate(conf, args, state, session)
+    else:
+        generate(conf, args, state)
+    return conf
+
+
+def generate(conf, args, state=None, session=None):
+    autobp = AutoBP(conf, stream=args.stream, optimize=args.optimize, state=state, session=session)
+    for section in SECTIONS:
+        if section in conf:
+            autobp.generate_section(section)
+    autobp.teardown()
     autobp.save()
 
 
+def teardown(conf, args, session=None):
+    """Delete everything conf creates on the tester, payload files included.
+
+    The config is generated without uploading anything, only to learn which
+    objects it creates and which of them use each other. Without a session
+    nothing is deleted here: delete.tcl is written and the command removing
+    the payload files is printed, to be run after it.
+    """
+    autobp = AutoBP(conf, optimize=args.optimize, upload=False)
+    for section in SECTIONS:
+        if section in conf:
+            autobp.generate_section(section)
+    if session is not None:
+        autobp.teardown(session)
+        return
+    autobp.teardown()
+    _, delete = autobp.tfiles.take()
+    with open(conf['General']['Prefix'] + 'delete.tcl', 'w') as deletefile:
+        deletefile.write(delete)
+    if autobp.payload_files:
+        # Nothing is deleted yet, the files must stay until delete.tcl has run
+        print('After running {0}delete.tcl, remove the payload files on {1} with:\n    {2}'.format(
+              conf['General']['Prefix'], conf['FileUpload']['Tester IP'], delete_command(autobp.payload_files)))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,190 @@
+"""Offline capacity check of a config before it is run on a tester.
+
+CapacityPlan works out, for the Test section of a config:
+
+  - sessions/s and bandwidth offered per superflow, from the component rates
+    and the app profile weights (by flows or by bandwidth) or, for AUTOMATIC
+    components, the per-superflow rates bpauto generates
+  - the load on every interface. Components use -rateDist.scope per_if, so
+    Max Sessions per sec applies on each client interface their Client Tags
+    resolve to, and the server interfaces share the sum
+  - how long a session may last before Max Sessions caps the rate
+  - the step ramp of every component and whether it reaches its target
+    within Ramp Up Duration
+
+Bandwidth is transaction bytes per session, without protocol overhead.
+Problems are collected in warnings.
+"""
+
+import json
+
+from bpauto import RAMP_INTERVAL, RAMP_MIN, allocate_rates, ramp_increment
+from netplan import MAX_INTERFACE
+
+# Sessions must be allowed at least this long before Max Sessions is flagged
+MIN_SESSION_SECONDS = 1
+
+
+def _matches(name, prefix):
+    """Whether elements name1, name2, ... of a block can start with prefix."""
+    return name.startswith(prefix) or (prefix.startswith(name) and prefix[len(name):].isdigit())
+
+
+def interface_numbers(net_conf, container, seen=None):
+    """Numbers of the interfaces under the containers whose names start with container."""
+    seen = set() if seen is None else seen
+    if container in seen:
+        return set()
+    seen.add(container)
+    numbers = set()
+    for block in net_conf.get('Interfaces') or []:
+        if _matches(block['Name'], container):
+            numbers.update(range(block['Start Number'], MAX_INTERFACE, block['Increment'])[:block['Count']])
+    for key in ('VLANs', 'IP Routers'):
+        for block in net_conf.get(key) or []:
+            if _matches(block['Name'], container):
+                numbers |= interface_numbers(net_conf, block['Container'], seen)
+    return numbers
+
+
+def tag_interfaces(net_conf, tag):
+    numbers = set()
+    for hosts in net_conf.get('IP Static Hosts') or []:
+        if tag == hosts['Name'] or (tag.startswith(hosts['Name']) and tag[len(hosts['Name']):].isdigit()):
+            numbers |= interface_numbers(net_conf, hosts['Container'])
+    return sorted(numbers)
+
+
+def ramp(rate, comp_conf):
+    """The step ramp _gen_comp configures, as a list of timeline points."""
+    ramp_up = comp_conf['Ramp Up Duration']
+    increment = ramp_increment(rate, ramp_up)
+    to_target = -(-(rate - RAMP_MIN) // increment) * RAMP_INTERVAL
+    steady = ramp_up + comp_conf['Steady State Duration']
+    timeline = [{'second': 0, 'phase': 'ramp up', 'rate': RAMP_MIN}]
+    if to_target <= ramp_up:
+        timeline.append({'second': to_target, 'phase': 'target', 'rate': rate})
+    else:
+        timeline.append({'second': ramp_up, 'phase': 'ramp end',
+                         'rate': min(rate, RAMP_MIN + increment * (ramp_up // RAMP_INTERVAL))})
+    timeline += [{'second': ramp_up, 'phase': 'steady', 'rate': rate},
+                 {'second': steady, 'phase': 'ramp down', 'rate': rate},
+                 {'second': steady + comp_conf['Ramp Down Duration'], 'phase': 'end', 'rate': 0}]
+    return {'increment': increment, 'seconds to target': to_target,
+            'reached': to_target <= ramp_up, 'timeline': timeline}
+
+
+class CapacityPlan(object):
+    def __init__(self, conf, line_rate=10e9):
+        self.line_rate = line_rate
+        self.warnings = []
+        self._net_conf = conf.get('Network') or {}
+        self._sizes = {superflow['Name']: superflow.get('Transation Size')
+                       for superflow in conf.get('Super Flows') or []}
+        self._profiles = {profile['Name']: profile for profile in conf.get('Application Profiles') or []}
+        self.components = []
+        self.superflows = {}
+        self.interfaces = {}
+        for comp_conf in (conf.get('Test') or {}).get('Components') or []:
+            self._plan_component(comp_conf)
+        for number, bits in sorted(self.interfaces.items()):
+            if bits > line_rate:
+                self.warnings.append('interface {0}: {1:.1f} Mbit/s exceeds the {2:.1f} Mbit/s line rate'.format(
+                                     number, bits / 1e6, line_rate / 1e6))
+
+    def _split(self, comp_conf):
+        """[(component, sessions/s, [(superflow, sessions/s)])] of the components a config entry creates."""
+        profile = self._profiles.get(comp_conf['Application Profile'])
+        rate = comp_conf['Max Sessions per sec']
+        if profile is None:
+            self.warnings.append('component "{0}": app profile "{1}" is not in the config, its mix is unknown'.format(
+                                 comp_conf['Name'], comp_conf['Application Profile']))
+            return [(comp_conf['Name'], rate, [(None, rate)])]
+        superflows = profile['Super Flows']
+        weights = [superflow['Weight'] for superflow in superflows]
+        if comp_conf['Name'] == 'AUTOMATIC':
+            try:
+                parts = allocate_rates(rate, weights)
+            except ValueError as e:
+                self.warnings.append('component "{0}": {1}'.format(comp_conf['Name'], e))
+                return []
+            return [(superflow['Name'], part, [(superflow['Name'], part)])
+                    for superflow, part in zip(superflows, parts)]
+        sizes = [self._sizes.get(superflow['Name']) for superflow in superflows]
+        if profile['Weight According to'] == 'bandwidth' and all(sizes):
+            # Weights split bandwidth, so sessions go by weight per transaction byte
+            weights = [weight / size for weight, size in zip(weights, sizes)]
+        total = sum(weights)
+        return [(comp_conf['Name'], rate, [(superflow['Name'], rate * weight / total if total else 0)
+                                           for superflow, weight in zip(superflows, weights)])]
+
+    def _plan_component(self, comp_conf):
+        clients = tag_interfaces(self._net_conf, comp_conf['Client Tags']) or [None]
+        servers = tag_interfaces(self._net_conf, comp_conf['Server Tags']) or [None]
+        for name, rate, flows in self._split(comp_conf):
+            bits = 0
+            for superflow, sessions in flows:
+                size = self._sizes.get(superflow)
+                flow_bits = sessions * size * 8 if size is not None else None
+                totals = self.superflows.setdefault(superflow, {'sessions': 0, 'bits': 0})
+                totals['sessions'] += sessions * len(clients)
+                if flow_bits is None or totals['bits'] is None:
+                    totals['bits'] = None
+                else:
+                    totals['bits'] += flow_bits * len(clients)
+                bits = None if flow_bits is None or bits is None else bits + flow_bits
+
+            component = {'name': name, 'sessions per interface': rate, 'bits per interface': bits,
+                         'client interfaces': clients, 'server interfaces': servers,
+                         'max sessions': comp_conf['Max Sessions'],
+                         'max session seconds': comp_conf['Max Sessions'] / rate if rate else None,
+                         'ramp': ramp(rate, comp_conf) if rate else None}
+            self.components.append(component)
+            if bits is not None:
+                for number in clients:
+                    self.interfaces[number] = self.interfaces.get(number, 0) + bits
+                for number in servers:
+                    self.interfaces[number] = self.interfaces.get(number, 0) + bits * len(clients) / len(servers)
+
+            if component['ramp'] is not None and not component['ramp']['reached']:
+                self.warnings.append('component "{0}": ramps to {1} of {2} sessions/s in {3} s, '
+                                     'the target is reached after {4} s'.format(
+                                     name, component['ramp']['timeline'][1]['rate'], rate,
+                                     comp_conf['Ramp Up Duration'], component['ramp']['seconds to target']))
+            if component['max session seconds'] is not None and component['max session seconds'] < MIN_SESSION_SECONDS:
+                self.warnings.append('component "{0}": Max Sessions {1} at {2} sessions/s caps the rate unless '
+                                     'sessions finish within {3:.2f} s'.format(
+                                     name, comp_conf['Max Sessions'], rate, component['max session seconds']))
+
+    def report(self):
+        lines = ['{0:<32} {1:>12} {2:>12}'.format('superflow', 'sessions/s', 'Mbit/s')]
+        for superflow, totals in self.superflows.items():
+            bits = '?' if totals['bits'] is None else '{0:.1f}'.format(totals['bits'] / 1e6)
+            lines.append('{0:<32} {1:>12.1f} {2:>12}'.format(superflow or '?', totals['sessions'], bits))
+        lines.append('')
+        lines.append('{0:<32} {1:>12} {2:>12} {3:>10} {4:>10}'.format(
+                     'component', 'per if/s', 'interfaces', 'target s', 'max sess s'))
+        for component in self.components:
+            ramp_ = component['ramp']
+            lines.append('{0:<32} {1:>12} {2:>12} {3:>10} {4:>10}'.format(
+                         component['name'], component['sessions per interface'],
+                         len(component['client interfaces']),
+                         '-' if ramp_ is None else ramp_['seconds to target'],
+                         '-' if component['max session seconds'] is None
+                         else '{0:.1f}'.format(component['max session seconds'])))
+        if self.interfaces:
+            lines.append('')
+            lines.append('{0:<32} {1:>12} {2:>12}'.format('interface', 'Mbit/s', 'line rate'))
+            for number, bits in sorted(self.interfaces.items(), key=lambda item: (item[0] is None, item[0] or 0)):
+                lines.append('{0:<32} {1:>12.1f} {2:>11.1f}%'.format(
+                             '?' if number is None else str(number), bits / 1e6, 100 * bits / self.line_rate))
+        lines += ['WARNING: ' + warning for warning in self.warnings]
+        return '\n'.join(lines)
+
+    def save(self, path):
+        with open(path, 'w') as planfile:
+            json.dump({'line rate': self.line_rate,
+                       'superflows': [dict(totals, superflow=superflow) for superflow, totals in self.superflows.items()],
+                       'components': self.components,
+                       'interfaces': [{'interface': number, 'bits': bits} for number, bits in self.interfaces.items()],
+                       'warnings': self.warnings}, planfile, indent=2)
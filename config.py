@@ -0,0 +1,153 @@
+"""Loading and validating bpauto configuration files.
+
+YAML is parsed with the libyaml based CSafeLoader when PyYAML was built with
+it. schema.yaml uses the pykwalify rule subset (type, required, pattern,
+range, enum, mapping with "=" for any key, sequence); it is compiled once into
+nested check functions. A validated config is stored as JSON in .<name>.cache
+next to the YAML file, keyed by the file's mtime, size and hash and by the
+schema hash, so unchanged configs skip parsing and validation on later runs.
+The cache only holds data, so a planted cache file cannot run code. Configs
+JSON cannot represent exactly (dates, non-string keys) are not cached.
+"""
+
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.yaml')
+
+_TYPES = {
+    'str': lambda value: isinstance(value, str),
+    'int': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'bool': lambda value: isinstance(value, bool),
+    'map': lambda value: isinstance(value, dict),
+    'seq': lambda value: isinstance(value, list),
+    'any': lambda value: True,
+}
+
+
+def load_yaml(stream):
+    # Imported here so configs served from the cache never load PyYAML
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def _compile(rule):
+    """Turn a schema rule into a function(value, path, errors)."""
+    kind = rule.get('type', 'str')
+    is_type = _TYPES[kind]
+    pattern = re.compile(rule['pattern']) if 'pattern' in rule else None
+    enum = rule.get('enum')
+    limits = rule.get('range', {})
+    mapping = {key: (_compile(sub), sub.get('required', False))
+               for key, sub in (rule.get('mapping') or {}).items()}
+    default = mapping.pop('=', None)
+    sequence = _compile(rule['sequence'][0]) if rule.get('sequence') else None
+
+    def check(value, path, errors):
+        if value is None:
+            return
+        if not is_type(value):
+            errors.append('{0}: {1!r} is not a {2}'.format(path, value, kind))
+            return
+        if pattern is not None and not pattern.match(str(value)):
+            errors.append('{0}: {1!r} does not match {2}'.format(path, value, pattern.pattern))
+        if enum is not None and value not in enum:
+            errors.append('{0}: {1!r} is not one of {2}'.format(path, value, ', '.join(map(str, enum))))
+        if 'min' in limits and value < limits['min']:
+            errors.append('{0}: {1!r} is below {2}'.format(path, value, limits['min']))
+        if 'max' in limits and value > limits['max']:
+            errors.append('{0}: {1!r} is above {2}'.format(path, value, limits['max']))
+        if kind == 'map':
+            for key, (_, required) in mapping.items():
+                if required and value.get(key) is None:
+                    errors.append('{0}/{1}: required'.format(path, key))
+            for key, item in value.items():
+                if key in mapping:
+                    mapping[key][0](item, '{0}/{1}'.format(path, key), errors)
+                elif default is not None:
+                    default[0](item, '{0}/{1}'.format(path, key), errors)
+                elif rule.get('mapping') is not None:
+                    errors.append('{0}/{1}: unknown key'.format(path, key))
+        elif kind == 'seq' and sequence is not None:
+            for index, item in enumerate(value):
+                sequence(item, '{0}/{1}'.format(path, index), errors)
+
+    return check
+
+
+def _file_hash(path):
+    with open(path, 'rb') as datafile:
+        return hashlib.sha256(datafile.read()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def compile_schema(path=SCHEMA):
+    with open(path) as schemafile:
+        return _compile(load_yaml(schemafile))
+
+
+def validate(conf, schema=SCHEMA):
+    check = compile_schema(schema)
+    errors = []
+    check(conf, '', errors)
+    if errors:
+        raise ValueError('Invalid configuration:\n  ' + '\n  '.join(errors))
+
+
+def load_config(path, schema=SCHEMA, use_cache=True, validation=True):
+    """Parse (and validate) a config file, reusing the cached result of an earlier run."""
+    directory, name = os.path.split(path)
+    cache_path = os.path.join(directory, '.' + name + '.cache')
+    stat = os.stat(path)
+    schema_hash = _file_hash(schema) if validation else None
+
+    cached = None
+    if use_cache:
+        try:
+            with open(cache_path, 'rb') as cachefile:
+                cached = json.load(cachefile)
+        except (OSError, ValueError):
+            cached = None
+    if isinstance(cached, dict) and cached.get('schema') == schema_hash:
+        if (cached['mtime'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+            return cached['conf']
+        digest = _file_hash(path)
+        if cached['hash'] == digest:
+            cached['mtime'], cached['size'] = stat.st_mtime_ns, stat.st_size
+            _write_cache(cache_path, cached)
+            return cached['conf']
+
+    with open(path, 'rb') as configfile:
+        data = configfile.read()
+    conf = load_yaml(data)
+    if validation:
+        validate(conf, schema)
+    if use_cache:
+        _write_cache(cache_path, {'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                                  'hash': hashlib.sha256(data).hexdigest(),
+                                  'schema': schema_hash, 'conf': conf})
+    return conf
+
+
+def _write_cache(cache_path, cached):
+    try:
+        text = json.dumps(cached)
+    except (TypeError, ValueError):
+        return
+    if json.loads(text) != cached:
+        # Integer keys would come back as strings
+        return
+    try:
+        with open(cache_path + '.tmp', 'w') as cachefile:
+            cachefile.write(text)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+        pass
@@ -0,0 +1,139 @@
+"""Running generated TCL against a persistent Tcl shell.
+
+TclSession starts the shell once with live.tcl as its script and is handed
+to TCLFiles in place of the create buffer. Commands are sent in batches of
+`batch` lines without waiting for earlier batches to finish; a reader thread
+collects the acknowledgements, so generation and execution overlap. At most
+`window` batches are in flight at a time.
+
+With stub=True live_stub.tcl is sourced first. It mimics the $bps, $n and
+$test objects, so sessions can run and be benchmarked without a tester:
+
+    session = TclSession(stub=True)
+"""
+
+import os
+import subprocess
+import sys
+import threading
+
+DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'live.tcl')
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'live_stub.tcl')
+MARK = '@@bpauto '
+
+
+class TclError(Exception):
+    pass
+
+
+class TclSession(object):
+    def __init__(self, shell=('tclsh',), batch=100, window=4, stub=False, output=sys.stdout):
+        self._batch = batch
+        self._window = window
+        self._output = output
+        self._pending = []
+        self._lines = 0
+        self._sent = 0
+        self._acked = 0
+        self._error = None
+        self._alive = True
+        self._cond = threading.Condition()
+        self._process = subprocess.Popen(list(shell) + [DRIVER] + ([STUB] if stub else []),
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding='utf-8')
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.kill()
+
+    def _read(self):
+        for line in self._process.stdout:
+            if not line.startswith(MARK):
+                if self._output is not None:
+                    self._output.write(line)
+                continue
+            status, batch, message = (line[len(MARK):].rstrip('\n').split(' ', 2) + [''])[:3]
+            with self._cond:
+                if status == 'error':
+                    self._error = 'batch {0}: {1}'.format(batch, message)
+                self._acked = int(batch)
+                self._cond.notify_all()
+        with self._cond:
+            self._alive = False
+            self._cond.notify_all()
+
+    def _check(self):
+        if self._error is not None:
+            raise TclError(self._error)
+        if not self._alive:
+            raise TclError('Tcl shell exited after {0} of {1} batches'.format(self._acked, self._sent))
+
+    def write(self, text):
+        self._pending.append(text)
+        self._lines += text.count('\n')
+        # Only cut batches after a full line, the driver waits for complete commands itself
+        if self._lines >= self._batch and text.endswith('\n'):
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        self._lines = 0
+        with self._cond:
+            while self._sent - self._acked >= self._window and self._alive and self._error is None:
+                self._cond.wait()
+            self._check()
+            self._sent += 1
+            batch = self._sent
+        try:
+            self._process.stdin.write('{0} {1}\n'.format(batch, len(text)))
+            self._process.stdin.write(text)
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            self._reader.join()
+            self._check()
+            raise
+
+    def wait(self):
+        """Block until every batch sent so far has been executed."""
+        self.flush()
+        with self._cond:
+            while self._acked < self._sent and self._alive and self._error is None:
+                self._cond.wait()
+            self._check()
+
+    def close(self):
+        if self._process.stdin.closed:
+            return
+        try:
+            self.wait()
+        finally:
+            self._close_stdin()
+            status = self._process.wait()
+            self._reader.join()
+        if status:
+            raise TclError('Tcl shell exited with status {0}'.format(status))
+
+    def kill(self):
+        self._process.kill()
+        self._process.wait()
+        self._reader.join()
+        self._close_stdin()
+
+    def _close_stdin(self):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
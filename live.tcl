@@ -0,0 +1,28 @@
+# Driver for bpauto live sessions, see live.py.
+#
+# Files given as arguments are sourced first. stdin then carries batches, each
+# a "<batch> <length>" line followed by <length> characters of TCL. Text is
+# evaluated at global level as soon as it holds complete commands, and every
+# batch is acknowledged on stdout with "@@bpauto ok <batch>" or
+# "@@bpauto error <batch> <message>". The first error ends the session.
+
+fconfigure stdin -encoding utf-8 -translation lf
+fconfigure stdout -encoding utf-8 -translation lf -buffering line
+
+foreach bpauto_file $argv {
+    source $bpauto_file
+}
+
+set bpauto_pending ""
+while {[gets stdin bpauto_header] >= 0} {
+    lassign $bpauto_header bpauto_batch bpauto_length
+    append bpauto_pending [read stdin $bpauto_length]
+    if {[info complete $bpauto_pending]} {
+        if {[catch {uplevel #0 $bpauto_pending} bpauto_error]} {
+            puts "@@bpauto error $bpauto_batch [string map {\n { }} $bpauto_error]"
+            exit 1
+        }
+        set bpauto_pending ""
+    }
+    puts "@@bpauto ok $bpauto_batch"
+}
@@ -0,0 +1,24 @@
+# Offline stand-in for the BreakingPoint TCL API, used by live sessions with
+# stub=True. bps::connect and every object it hands out print the calls made
+# on them; create* calls return a new object.
+
+namespace eval bps {
+    variable objects 0
+}
+
+proc bps::object {kind} {
+    variable objects
+    set name ::bps::[string tolower $kind][incr objects]
+    proc $name {args} [format {
+        puts [concat %1$s $args]
+        if {[string match create* [lindex $args 0]]} {
+            return [bps::object [string range [lindex $args 0] 6 end]]
+        }
+    } [list $name]]
+    return $name
+}
+
+proc bps::connect {args} {
+    puts [concat bps::connect $args]
+    return [bps::object bps]
+}
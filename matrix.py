@@ -0,0 +1,222 @@
+"""Batch compilation of parameter sweeps.
+
+A config with a Matrix section is expanded into one variant per combination
+of axis values, e.g.
+
+    Matrix:
+      - Path: [Test, Components, 0, Max Sessions per sec]
+        Values: [1000, 2000, 4000]
+      - Path: [Super Flows, 0, Transation Size]
+        Values: [10000, 100000]
+
+The network, every superflow, every application profile and the test are
+compiled on their own in a process pool. Objects whose inputs are the same in
+several variants are compiled once and shared. Every variant gets its own
+<prefix>V<n> create.tcl/delete.tcl, and its test name ends in V<n>.
+<prefix>matrix.json records the axis values of each variant.
+
+An object that differs between variants is named after the first variant
+with the same content, e.g. "HTTP V1" for V1 and V3 and "HTTP V2" for V2, and
+references to it follow, so loading one variant never changes another.
+Objects that are the same in every variant keep their name. Objects used by
+several variants are shared on the tester: variant delete scripts leave them
+alone and <prefix>shared delete.tcl deletes them once all variants are done.
+"""
+
+import json
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from collections import Counter
+from itertools import product
+
+from bpauto import AutoBP, SECTIONS
+from superflow import register_applications
+
+# Config sections each generated section reads
+SECTION_INPUTS = {
+    'Network': ('General', 'Network'),
+    'Super Flows': ('General', 'FileUpload', 'Applications', 'Super Flows'),
+    'Application Profiles': ('General', 'Application Profiles'),
+    'Test': ('General', 'Application Profiles', 'Test'),
+}
+
+
+def set_path(conf, path, value):
+    for key in path[:-1]:
+        conf = conf[key]
+    conf[path[-1]] = value
+
+
+def rename_objects(conf, sections, suffix, names=None):
+    """Append suffix to the names of the objects the sections create and to references to them.
+
+    With names set, only superflows and application profiles of those names are renamed.
+    """
+    if 'Network' in sections:
+        name = conf['Network']['Name']
+        conf['Network']['Name'] += suffix
+        if 'Test' in conf and conf['Test']['Network'] == name:
+            conf['Test']['Network'] += suffix
+    if 'Super Flows' in sections:
+        renamed = {superflow['Name'] for superflow in conf['Super Flows'] if names is None or superflow['Name'] in names}
+        for superflow in conf['Super Flows']:
+            if superflow['Name'] in renamed:
+                superflow['Name'] += suffix
+        for profile in conf.get('Application Profiles') or []:
+            for superflow in profile['Super Flows']:
+                if superflow['Name'] in renamed:
+                    superflow['Name'] += suffix
+    if 'Application Profiles' in sections:
+        renamed = {profile['Name'] for profile in conf['Application Profiles'] if names is None or profile['Name'] in names}
+        for profile in conf['Application Profiles']:
+            if profile['Name'] in renamed:
+                profile['Name'] += suffix
+        for comp_conf in (conf.get('Test') or {}).get('Components') or []:
+            if comp_conf['Application Profile'] in renamed:
+                comp_conf['Application Profile'] += suffix
+    if 'Test' in sections:
+        conf['Test']['Name'] += suffix
+
+
+def expand_matrix(conf):
+    axes = conf['Matrix']
+    base = {key: value for key, value in conf.items() if key != 'Matrix'}
+    variants = []
+    for number, values in enumerate(product(*(axis['Values'] for axis in axes)), 1):
+        variant = deepcopy(base)
+        for axis, value in zip(axes, values):
+            set_path(variant, axis['Path'], value)
+        variants.append(('V{0}'.format(number), values, variant))
+
+    # Objects are renamed before the ones referring to them are compared
+    for section in ('Network', 'Super Flows', 'Application Profiles'):
+        if section not in base:
+            continue
+        keys = [{name: key for name, key, _ in section_units(variant, section)} for _, _, variant in variants]
+        for object_name in keys[0]:
+            if len({variant_keys.get(object_name) for variant_keys in keys}) == 1:
+                continue
+            first = {}
+            for (name, _, variant), variant_keys in zip(variants, keys):
+                suffix = ' ' + first.setdefault(variant_keys.get(object_name), name)
+                rename_objects(variant, {section}, suffix, {object_name})
+
+    for name, values, variant in variants:
+        if 'Test' in variant:
+            rename_objects(variant, {'Test'}, ' ' + name)
+        yield name, {' / '.join(map(str, axis['Path'])): value for axis, value in zip(axes, values)}, variant
+
+
+def section_key(conf, section):
+    return section, json.dumps([conf.get(key) for key in SECTION_INPUTS[section]], sort_keys=True, default=str)
+
+
+def section_units(conf, section):
+    """(name, key, conf) of each object the section creates, in creation order.
+
+    The conf of an object is the part of conf generating only that object;
+    objects with the same key generate the same commands in any variant.
+    """
+    if section == 'Super Flows':
+        groups = {}
+        for superflow in conf['Super Flows']:
+            groups.setdefault(superflow['Name'], []).append(superflow)
+        applications = conf.get('Applications') or {}
+        units = []
+        for name, superflows in groups.items():
+            unit = dict(conf)
+            unit['Super Flows'] = superflows
+            if 'Applications' in conf:
+                unit['Applications'] = {superflow['Application']: applications[superflow['Application']]
+                                        for superflow in superflows if superflow['Application'] in applications}
+            units.append((name, section_key(unit, section), unit))
+        return units
+    if section == 'Application Profiles':
+        units = []
+        for profile in conf['Application Profiles']:
+            unit = dict(conf)
+            unit['Application Profiles'] = [profile]
+            units.append((profile['Name'], section_key(unit, section), unit))
+        return units
+    return [(conf[section]['Name'], section_key(conf, section), conf)]
+
+
+def compile_section(conf, section, optimize=False):
+    """Generate one section of conf; returns its create text and the Teardown of the objects it creates."""
+    register_applications(conf.get('Applications') or {})
+    autobp = AutoBP(conf, optimize=optimize, connect=False)
+    autobp.generate_section(section)
+    create, _ = autobp.tfiles.take()
+    return create, autobp.tfiles.teardown
+
+
+def compose(conf, compiled, optimize=False, shared=frozenset()):
+    """Join compiled sections into create and delete scripts in tester order.
+
+    Objects in shared are left out of the delete script.
+    """
+    autobp = AutoBP(conf, optimize=optimize)
+    units = [compiled[key] for section in SECTIONS if section in conf for _, key, _ in section_units(conf, section)]
+    for unit in units:
+        # Uses between objects resolve once they are merged
+        autobp.tfiles.teardown.update(unit[1])
+    if shared:
+        teardown = autobp.tfiles.teardown
+        autobp.tfiles.teardown = teardown.select(set(teardown) - shared)
+    autobp.teardown()
+    create, delete = autobp.tfiles.take()
+    create += ''.join(unit[0] for unit in units)
+    return create, delete
+
+
+def compile_variants(variants, optimize=False, jobs=None, share=False):
+    """Compile (name, conf) variants, sharing identical objects, into <prefix><name> scripts.
+
+    A single variant with an empty name compiles one config's objects in
+    parallel into the same <prefix>create.tcl/delete.tcl a sequential run writes.
+
+    With share=True the variants run on the same tester: objects created by
+    several variants are deleted by <prefix>shared delete.tcl only.
+    """
+    jobs_conf = {}
+    for _, variant in variants:
+        for section in SECTIONS:
+            if section in variant:
+                for _, key, unit in section_units(variant, section):
+                    jobs_conf.setdefault(key, (unit, section))
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {key: pool.submit(compile_section, unit, section, optimize)
+                   for key, (unit, section) in jobs_conf.items()}
+        compiled = {key: future.result() for key, future in futures.items()}
+
+    shared = frozenset()
+    if share and variants:
+        teardowns = [[compiled[key][1] for section in SECTIONS if section in variant
+                      for _, key, _ in section_units(variant, section)]
+                     for _, variant in variants]
+        counts = Counter(node for teardown in teardowns for node in set().union(*teardown))
+        shared = frozenset(node for node, count in counts.items() if count > 1)
+        autobp = AutoBP(variants[0][1], optimize=optimize)
+        for teardown in teardowns:
+            for section in teardown:
+                autobp.tfiles.teardown.update(section)
+        autobp.tfiles.teardown = autobp.tfiles.teardown.select(shared)
+        autobp.teardown()
+        with open(variants[0][1]['General']['Prefix'] + 'shared delete.tcl', 'w') as deletefile:
+            deletefile.write(autobp.tfiles.take()[1])
+
+    for name, variant in variants:
+        prefix = variant['General']['Prefix'] + (name + ' ' if name else '')
+        create, delete = compose(variant, compiled, optimize, shared)
+        with open(prefix + 'create.tcl', 'w') as createfile:
+            createfile.write(create)
+        with open(prefix + 'delete.tcl', 'w') as deletefile:
+            deletefile.write(delete)
+
+
+def run_matrix(conf, optimize=False, jobs=None):
+    variants = list(expand_matrix(conf))
+    compile_variants([(name, variant) for name, _, variant in variants], optimize, jobs, share=True)
+    with open(conf['General']['Prefix'] + 'matrix.json', 'w') as matrixfile:
+        json.dump([{'Name': name, 'Values': values} for name, values, _ in variants], matrixfile, indent=2)
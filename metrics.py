@@ -0,0 +1,217 @@
+"""Per-stage profiling of bpauto runs.
+
+Code marks stages with
+
+    with stage('hosts'):
+        ...
+
+Stages nest, so this one is reported as Network/hosts when entered while
+generating the Network section. Outside an active Profiler stage() does
+nothing. A Profiler totals, per stage:
+
+    calls       times the stage was entered
+    seconds     wall time, including nested stages
+    commands    TCL commands emitted, by object type (deletes as "delete")
+    bytes       TCL bytes emitted
+    peak_bytes  tracemalloc peak, only with Profiler(memory=True)
+
+Like seconds, commands and bytes include those of nested stages. stage() is
+meant for the generating thread; worker threads time their work with
+timer(), which only records calls and seconds.
+
+Output buffers that hold back commands (TCLFiles merging configure calls
+under -O) register a flush with add_flush(). It runs on entering and
+leaving every stage, so held commands are counted in the stage that
+produced them.
+
+Functions passed to add_hook() are called as hook(name, record) whenever a
+stage or timer ends, with the figures of that single call, e.g. to feed an
+external metrics exporter.
+"""
+
+import json
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+# Variables the generated TCL keeps each kind of object in
+OBJECTS = {
+    'bps': 'bps',
+    'n': 'network',
+    'containers': 'network',
+    'test': 'test',
+    'comp': 'component',
+    'superflow': 'superflow',
+    'appprofile': 'appprofile',
+}
+
+_profiler = None
+_hooks = []
+
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def current():
+    return _profiler
+
+
+@contextmanager
+def stage(name):
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.stage(name):
+            yield
+
+
+@contextmanager
+def timer(name):
+    if _profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profiler.record(name, time.perf_counter() - start)
+
+
+def object_type(command):
+    words = command.split(None, 2)
+    if not words:
+        return 'other'
+    if words[0] == 'set' and len(words) > 1:
+        name = words[1]
+    else:
+        name = words[0].lstrip('$')
+    return OBJECTS.get(name, name)
+
+
+class Profiler(object):
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = {}
+        self._stack = []
+        self._lock = Lock()
+        self._previous = None
+        self._tracing = False
+        self._flushes = []
+
+    def add_flush(self, flush):
+        """Call flush when a stage is entered or left, so held output lands in the stage that produced it."""
+        self._flushes.append(flush)
+
+    def _flush(self):
+        for flush in self._flushes:
+            flush()
+
+    def __enter__(self):
+        global _profiler
+        self._previous, _profiler = _profiler, self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        return self
+
+    def __exit__(self, *exc):
+        global _profiler
+        _profiler = self._previous
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _totals(self, name):
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'commands': Counter(), 'bytes': 0}
+            if self.memory:
+                totals['peak_bytes'] = 0
+        return totals
+
+    @contextmanager
+    def stage(self, name):
+        self._flush()
+        if self._stack:
+            name = self._stack[-1]['name'] + '/' + name
+            if self.memory:
+                parent = self._stack[-1]
+                parent['peak_bytes'] = max(parent['peak_bytes'], tracemalloc.get_traced_memory()[1])
+        # Created on entry so stages are reported in the order they start
+        self._totals(name)
+        frame = {'name': name, 'commands': Counter(), 'bytes': 0, 'peak_bytes': 0}
+        self._stack.append(frame)
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+            self._flush()
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            record = {'seconds': seconds, 'commands': frame['commands'], 'bytes': frame['bytes']}
+            if self.memory:
+                record['peak_bytes'] = max(frame['peak_bytes'], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent['peak_bytes'] = max(parent['peak_bytes'], record['peak_bytes'])
+            self._add(name, record)
+
+    def _add(self, name, record):
+        with self._lock:
+            totals = self._totals(name)
+            totals['calls'] += 1
+            totals['seconds'] += record['seconds']
+            totals['commands'].update(record.get('commands', {}))
+            totals['bytes'] += record.get('bytes', 0)
+            if 'peak_bytes' in record:
+                totals['peak_bytes'] = max(totals['peak_bytes'], record['peak_bytes'])
+        for hook in _hooks:
+            hook(name, record)
+
+    def record(self, name, seconds):
+        """Add a call of seconds to stage name, from any thread."""
+        self._add(name, {'seconds': seconds})
+
+    def command(self, command, delete=False):
+        kind = 'delete' if delete else object_type(command)
+        for frame in self._stack:
+            frame['commands'][kind] += 1
+            frame['bytes'] += len(command) + 1
+
+    def commands(self, commands):
+        for command in commands:
+            self.command(command)
+            yield command
+
+    def report(self):
+        lines = ['{0:<32} {1:>6} {2:>9} {3:>9} {4:>11}'.format('stage', 'calls', 'seconds', 'commands', 'bytes') +
+                 (' {0:>10}'.format('peak MiB') if self.memory else '')]
+        overall = Counter()
+        for name, totals in self.stages.items():
+            if '/' not in name:
+                overall.update(totals['commands'])
+            line = '{0:<32} {1:>6} {2:>9.3f} {3:>9} {4:>11}'.format(
+                   '  ' * name.count('/') + name.rsplit('/', 1)[-1], totals['calls'], totals['seconds'],
+                   sum(totals['commands'].values()), totals['bytes'])
+            if self.memory:
+                line += ' {0:>10.1f}'.format(totals.get('peak_bytes', 0) / (1 << 20))
+            lines.append(line)
+        if overall:
+            lines.append('commands: ' + ', '.join('{0} {1}'.format(kind, count)
+                                                 for kind, count in overall.most_common()))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        stages = [{'stage': name, **totals, 'seconds': round(totals['seconds'], 6), 'commands': dict(totals['commands'])}
+                  for name, totals in self.stages.items()]
+        with open(path, 'w') as profilefile:
+            json.dump({'memory': self.memory, 'stages': stages}, profilefile, indent=2)
@@ -0,0 +1,212 @@
+"""Address planning for generated BreakingPoint networks.
+
+NetworkPlan computes the names, interface numbers, VLAN ids, MAC and IP
+addresses of every network block as integer ranges and formats them in bulk.
+Pool exhaustion and overlapping host subnets are reported before any TCL is
+emitted.
+"""
+
+from ipaddress import IPv4Address
+
+MAX_INTERFACE = 255
+MAX_VLAN = 4096
+MAX_NAME_INDEX = 1000
+MAX_IPV4 = 0xFFFFFFFF
+
+
+def format_ipv4(values):
+    return ['%d.%d.%d.%d' % (v >> 24, v >> 16 & 255, v >> 8 & 255, v & 255) for v in values]
+
+
+def ipv4_range(name, ip_address, inc_mask, count):
+    start, step = ipv4_step(ip_address, inc_mask)
+    last = start + step * (count - 1)
+    if last > MAX_IPV4:
+        raise ValueError('"{0}": {1} addresses from {2} by {3} run past 255.255.255.255'.format(
+                         name, count, ip_address, inc_mask))
+    if step == 0:
+        return [start] * count
+    return range(start, last + 1, step)
+
+
+def ipv4_step(ip_address, inc_mask):
+    return int(IPv4Address(ip_address)), int(IPv4Address(inc_mask))
+
+
+def take(name, what, values, count):
+    if count > len(values):
+        raise ValueError('"{0}": {1} {2} requested, only {3} available'.format(name, count, what, len(values)))
+    return values[:count]
+
+
+# The default pool is 02:1A:c5:01:00:00 - 02:1A:fe:fe:00:00 without the :00 and
+# :ff fourth octets, as generated before pools were configurable
+DEFAULT_MAC_START = '02:1A:c5:01:00:00'
+DEFAULT_MAC_END = '02:1A:fe:fe:00:00'
+DEFAULT_MAC_RESERVED = tuple(('02:1A:%02x:ff:00:00' % third, '02:1A:%02x:00:00:00' % (third + 1))
+                             for third in range(0xc5, 0xfe))
+# With Contiguous every address up to here is handed out
+CONTIGUOUS_MAC_END = '02:1A:ff:ff:00:00'
+
+
+def parse_mac(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+
+class MacAllocator(object):
+    """Allocates interface and VLAN MAC addresses from Start to End in Step increments.
+
+    The default pool skips addresses whose fourth octet is 00 or ff, so it
+    yields the same MACs as before pools were configurable. MAC Pool:
+    Contiguous: True hands out the whole range up to 02:1A:ff:ff:00:00 instead.
+
+    Reserved ranges are never handed out. Sub pools carve a fixed number of
+    addresses off the front of the pool for blocks that name them, the rest
+    is shared. Allocation pops from a list of free intervals.
+    """
+    def __init__(self, start=DEFAULT_MAC_START, end=DEFAULT_MAC_END, step=1 << 16,
+                 reserved=DEFAULT_MAC_RESERVED, sub_pools=None):
+        self._start = parse_mac(start)
+        self._step = step
+        last = (parse_mac(end) - self._start) // step
+        # Octets shared by every address in the pool are kept as written in Start
+        fixed = 0
+        while fixed < 6 and (self._start >> (40 - 8 * fixed)) == (parse_mac(end) >> (40 - 8 * fixed)):
+            fixed += 1
+        self._prefix = ':'.join(start.replace('-', ':').split(':')[:fixed])
+        self._octets = 6 - fixed
+
+        free = [(0, last)]
+        for first_mac, last_mac in sorted(reserved):
+            first = -(-(parse_mac(first_mac) - self._start) // step)
+            stop = (parse_mac(last_mac) - self._start) // step
+            free = [part for lo, hi in free
+                    for part in ((lo, min(hi, first - 1)), (max(lo, stop + 1), hi)) if part[0] <= part[1]]
+        self._pools = {None: free}
+        for name, size in (sub_pools or {}).items():
+            self._pools[name] = self._carve(None, size, name)
+
+    def __contains__(self, pool):
+        return pool in self._pools
+
+    def capacity(self, pool=None):
+        return sum(hi - lo + 1 for lo, hi in self._pools[pool])
+
+    def _carve(self, pool, count, name):
+        if pool not in self:
+            raise ValueError('"{0}": unknown MAC pool "{1}"'.format(name, pool))
+        free = self._pools[pool]
+        if count > self.capacity(pool):
+            raise ValueError('"{0}": {1} MAC addresses requested, only {2} left in pool {3}'.format(
+                             name, count, self.capacity(pool), pool or 'shared'))
+        taken = []
+        while count:
+            lo, hi = free[0]
+            n = min(count, hi - lo + 1)
+            taken.append((lo, lo + n - 1))
+            if lo + n > hi:
+                free.pop(0)
+            else:
+                free[0] = (lo + n, hi)
+            count -= n
+        return taken
+
+    def allocate(self, name, count, pool=None):
+        macs = []
+        for lo, hi in self._carve(pool, count, name):
+            macs.extend(self.format(range(lo, hi + 1)))
+        return macs
+
+    def format(self, indexes):
+        octets = self._octets
+        shifts = range(8 * (octets - 1), -1, -8)
+        fmt = ':'.join([self._prefix] * bool(self._prefix) + ['%02x'] * octets)
+        return [fmt % tuple((self._start + i * self._step) >> shift & 255 for shift in shifts) for i in indexes]
+
+
+def mac_allocator(net_conf):
+    conf = net_conf.get('MAC Pool') or {}
+    kwargs = {}
+    for key, arg in (('Start', 'start'), ('End', 'end'), ('Step', 'step')):
+        if key in conf:
+            kwargs[arg] = conf[key]
+    reserved = [tuple(r) for r in conf.get('Reserved') or []]
+    if conf.get('Contiguous'):
+        kwargs.setdefault('end', CONTIGUOUS_MAC_END)
+    else:
+        reserved += DEFAULT_MAC_RESERVED
+    return MacAllocator(reserved=reserved, sub_pools=conf.get('Sub Pools'), **kwargs)
+
+
+class NetworkPlan(object):
+    def __init__(self, net_conf):
+        self.macs = mac_allocator(net_conf)
+        self._check_mac_capacity(net_conf)
+        self.interfaces = [self._plan_interfaces(conf) for conf in net_conf.get('Interfaces') or []]
+        self.vlans = [self._plan_vlans(conf) for conf in net_conf.get('VLANs') or []]
+        self.ip_routers = [self._plan_ip_routers(conf) for conf in net_conf.get('IP Routers') or []]
+        self.ip_static_hosts = [self._plan_hosts(conf) for conf in net_conf.get('IP Static Hosts') or []]
+        self._check_overlaps(net_conf.get('IP Static Hosts') or [], net_conf.get('IP Routers') or [])
+
+    def _check_mac_capacity(self, net_conf):
+        needed = {}
+        for conf in (net_conf.get('Interfaces') or []) + (net_conf.get('VLANs') or []):
+            pool = conf.get('MAC Pool')
+            needed[pool] = needed.get(pool, 0) + conf['Count']
+        for pool, count in needed.items():
+            if pool not in self.macs:
+                raise ValueError('unknown MAC pool "{0}"'.format(pool))
+            if count > self.macs.capacity(pool):
+                raise ValueError('{0} MAC addresses needed from pool {1}, capacity is {2}'.format(
+                                 count, pool or 'shared', self.macs.capacity(pool)))
+
+    def _names(self, prefix, indexes):
+        return [prefix + str(i) for i in indexes]
+
+    def _plan_interfaces(self, conf):
+        name = conf['Name']
+        numbers = take(name, 'interfaces', range(conf['Start Number'], MAX_INTERFACE, conf['Increment']), conf['Count'])
+        return {'names': self._names(name, numbers),
+                'numbers': numbers,
+                'macs': self.macs.allocate(name, conf['Count'], conf.get('MAC Pool'))}
+
+    def _plan_vlans(self, conf):
+        name = conf['Name']
+        ids = take(name, 'VLAN ids', range(conf['VLAN ID'], MAX_VLAN, conf['Increment']), conf['Count'])
+        return {'names': self._names(name, ids),
+                'ids': ids,
+                'macs': self.macs.allocate(name, conf['Count'], conf.get('MAC Pool'))}
+
+    def _plan_ip_routers(self, conf):
+        name = conf['Name']
+        indexes = take(name, 'IP routers', range(1, MAX_NAME_INDEX), conf['Count'])
+        return {'names': self._names(name, indexes),
+                'ips': format_ipv4(ipv4_range(name, conf['IP Address'], conf['Increment Mask'], conf['Count'])),
+                'gateways': format_ipv4(ipv4_range(name, conf['Gateway'], conf['Increment Mask'], conf['Count']))}
+
+    def _plan_hosts(self, conf):
+        name = conf['Name']
+        indexes = take(name, 'IP static hosts', range(1, MAX_NAME_INDEX), conf['Count'])
+        if conf['Gateway'] is not None:
+            gateways = format_ipv4(ipv4_range(name, conf['Gateway'], conf['Increment Mask'], conf['Count']))
+        else:
+            gateways = [None] * conf['Count']
+        return {'names': self._names(name, indexes),
+                'ips': format_ipv4(ipv4_range(name, conf['IP Address'], conf['Increment Mask'], conf['Count'])),
+                'gateways': gateways}
+
+    def _check_overlaps(self, hosts_conf, routers_conf=()):
+        """Host ranges and router subnets must not share addresses."""
+        ranges = []
+        for conf in hosts_conf:
+            for start in ipv4_range(conf['Name'], conf['IP Address'], conf['Increment Mask'], conf['Count']):
+                ranges.append((start, start + conf['IP Count'] - 1, 'IP static hosts "{0}"'.format(conf['Name'])))
+        for conf in routers_conf:
+            size = 1 << (32 - conf['Netmask'])
+            for address in ipv4_range(conf['Name'], conf['IP Address'], conf['Increment Mask'], conf['Count']):
+                start = address & -size
+                ranges.append((start, start + size - 1, 'IP router subnet "{0}"'.format(conf['Name'])))
+        ranges.sort()
+        for (_, prev_last, prev_name), (start, _, name) in zip(ranges, ranges[1:]):
+            if start <= prev_last:
+                raise ValueError('{0} and {1} overlap at {2}'.format(prev_name, name, format_ipv4([start])[0]))
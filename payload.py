@@ -1,41 +1,215 @@
-from itertools import repeat
-from paramiko import SSHClient
-from scp import SCPClient
+import os
+import random
+import string
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from shlex import quote
+
+from metrics import stage, timer
+
+CHUNK_SIZE = 1 << 20
+RESOURCES = "/resources/"
+MANIFEST = RESOURCES + ".bpauto_manifest"
+FILE_TYPES = ("zero", "asterisk", "binary", "ascii")
+
+# Random bytes below 208 map uniformly onto the 52 ASCII letters, the rest are dropped
+_ASCII_LIMIT = 4 * len(string.ascii_letters)
+_ASCII_TABLE = bytes((string.ascii_letters * 5)[:256], 'ascii')
+_ASCII_DROP = bytes(range(_ASCII_LIMIT, 256))
+
+
+def connect(hostname, adminlogin, adminpassword):
+    # paramiko is slow to import and only needed when something is uploaded
+    from paramiko import SSHClient
+    ssh = SSHClient()
+    ssh.load_system_host_keys()
+    ssh.connect(hostname, username=adminlogin, password=adminpassword)
+    return ssh
+
+
+def checksum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as datafile:
+        for chunk in iter(lambda: datafile.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def delete_command(filenames):
+    """The shell command removing filenames from /resources/ on the tester."""
+    return "rm -f " + " ".join(quote(RESOURCES + filename) for filename in filenames)
+
 
 class PayloadFile(object):
-    def __init__(self, *, prefix=None):
+    """Generates payload files and uploads them to the tester.
+
+    With cache_dir set, generated files are kept there keyed by file type,
+    size and seed and are reused on later runs. Uploads record checksums in a
+    manifest under /resources/ and are skipped when the tester already holds
+    an identical file.
+    """
+    def __init__(self, *, prefix=None, cache_dir=None):
         self._prefix = prefix
-    
-    def generate_file(self, filename, size, filetype):
+        self._cache_dir = cache_dir
+
+    def _check_filetype(self, filetype):
+        # Checked before anything is opened, so no empty or .tmp file is left behind
+        if filetype not in FILE_TYPES:
+            raise ValueError('Unknown file type: ' + filetype)
+
+    def _chunks(self, size, filetype, seed):
+        if seed is None:
+            randbytes = os.urandom
+        else:
+            randbytes = random.Random(seed).randbytes
+
         if filetype == "asterisk":
-            data = bytes(repeat(ord('*'), size))
+            block = b'*' * CHUNK_SIZE
+            for offset in range(0, size, CHUNK_SIZE):
+                yield block[:size - offset]
         elif filetype == "binary":
-            data = bytes(urandom(size))
+            for offset in range(0, size, CHUNK_SIZE):
+                yield randbytes(min(CHUNK_SIZE, size - offset))
         elif filetype == "ascii":
-            random_ascii = (ord(random.choice(string.ascii_letters)) for _ in range(size))
-            data = bytes(random_ascii)
+            remaining = size
+            while remaining > 0:
+                data = randbytes(min(CHUNK_SIZE, remaining + remaining // 4 + 64))
+                data = data.translate(_ASCII_TABLE, _ASCII_DROP)[:remaining]
+                remaining -= len(data)
+                yield data
 
-        with open(filename, "wb") as datafile:
-            datafile.write(data)
+    def generate_file(self, filename, size, filetype, seed=None):
+        """Write size bytes of filetype data in fixed-size chunks.
 
-    def upload_file(self, filename, hostname, adminlogin, adminpassword):
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.connect(hostname, username=adminlogin, password=adminpassword)
+        The "zero" type is written as a sparse file. A seed makes random
+        types reproducible.
+        """
+        self._check_filetype(filetype)
+        with stage('payload'), open(filename, "wb") as datafile:
+            if filetype == "zero":
+                datafile.truncate(size)
+                return
+            for chunk in self._chunks(size, filetype, seed):
+                datafile.write(chunk)
 
-        # SCPCLient takes a paramiko transport as its only argument
-        scp = SCPClient(ssh.get_transport())
+    def cached_file(self, filename, size, filetype, seed=None):
+        """Return a local path holding the payload, generating it only if needed."""
+        self._check_filetype(filetype)
+        if self._cache_dir is None:
+            self.generate_file(filename, size, filetype, seed=seed)
+            return filename
+        os.makedirs(self._cache_dir, exist_ok=True)
+        path = os.path.join(self._cache_dir, "{0}-{1}-{2}".format(filetype, size, seed))
+        if not os.path.exists(path):
+            tmppath = path + ".tmp"
+            self.generate_file(tmppath, size, filetype, seed=seed)
+            with open(tmppath + ".sha256", "w") as sumfile:
+                sumfile.write(checksum(tmppath))
+            os.replace(tmppath + ".sha256", path + ".sha256")
+            os.replace(tmppath, path)
+        return path
 
-        scp.put(filename, "/resources/" + filename)
+    def _local_checksum(self, path):
+        try:
+            with open(path + ".sha256") as sumfile:
+                return sumfile.read().strip()
+        except FileNotFoundError:
+            return checksum(path)
 
-        scp.close()
+    def _remote_manifest(self, ssh):
+        """Checksums of manifest entries whose files are still under /resources/."""
+        _, stdout, _ = ssh.exec_command("cat " + MANIFEST + " 2>/dev/null")
+        manifest = {}
+        for line in stdout.read().decode().splitlines():
+            digest, _, name = line.partition("  ")
+            manifest[name] = digest
+        _, stdout, _ = ssh.exec_command("ls -1 " + RESOURCES)
+        present = set(stdout.read().decode().splitlines())
+        return {name: digest for name, digest in manifest.items() if name in present}
+
+    def upload_file(self, filename, hostname, adminlogin, adminpassword, localpath=None):
+        with PayloadUploader(self, hostname, adminlogin, adminpassword, workers=1) as uploader:
+            return uploader.submit(filename, localpath).result()
 
     def delete_file(self, filename, hostname, adminlogin, adminpassword):
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.connect(hostname, username=adminlogin, password=adminpassword)
+        self.delete_files([filename], hostname, adminlogin, adminpassword)
+
+    def delete_files(self, filenames, hostname, adminlogin, adminpassword):
+        """Remove filenames from /resources/ with a single command.
+
+        Their manifest entries are left behind, _remote_manifest skips entries
+        whose files are gone.
+        """
+        ssh = connect(hostname, adminlogin, adminpassword)
+        try:
+            _, stdout, _ = ssh.exec_command(delete_command(filenames))
+            stdout.channel.recv_exit_status()
+        finally:
+            ssh.close()
+
+
+class PayloadUploader(object):
+    """Uploads payload files over one SSH connection per tester.
+
+    Each upload runs on its own SCP channel from a bounded thread pool, so
+    callers can keep generating payloads while earlier ones are uploaded.
+    """
+    def __init__(self, payload, hostname, adminlogin, adminpassword, workers=4):
+        self._payload = payload
+        self._hostname = hostname
+        self._adminlogin = adminlogin
+        self._adminpassword = adminpassword
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = Lock()
+        self._ssh = None
+        self._manifest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _session(self):
+        with self._lock:
+            if self._ssh is None:
+                self._ssh = connect(self._hostname, self._adminlogin, self._adminpassword)
+                self._manifest = self._payload._remote_manifest(self._ssh)
+            return self._ssh
+
+    def _upload(self, filename, localpath):
+        with timer('payload upload'):
+            return self._upload_file(filename, localpath)
+
+    def _upload_file(self, filename, localpath):
+        digest = self._payload._local_checksum(localpath)
+        ssh = self._session()
+        if self._manifest.get(filename) == digest:
+            return False
+
+        from scp import SCPClient
+
+        # SCPCLient takes a paramiko transport as its only argument
+        scp = SCPClient(ssh.get_transport())
+        scp.put(localpath, RESOURCES + filename)
+        scp.close()
+
+        with self._lock:
+            command = "echo {0} >> {1}".format(quote(digest + "  " + filename), MANIFEST)
+            _, stdout, _ = ssh.exec_command(command)
+            stdout.channel.recv_exit_status()
+            self._manifest[filename] = digest
+        return True
 
-        command = "rm -f /resources/" + quote(filename)
-        ssh.exec_command(command)
-        ssh.close()
+    def submit(self, filename, localpath=None):
+        """Queue an upload of localpath (default filename) to /resources/filename."""
+        if localpath is None:
+            localpath = filename
+        return self._pool.submit(self._upload, filename, localpath)
 
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self._ssh is not None:
+            self._ssh.close()
+            self._ssh = None
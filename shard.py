@@ -0,0 +1,180 @@
+"""Splitting one test across several testers.
+
+A config with a Shards section, e.g.
+
+    Shards:
+      - Tester IP: 10.0.0.1
+        Weight: 2
+      - Tester IP: 10.0.0.2
+        Login: admin
+        Password: admin
+        Weight: 1
+
+is split into one config per tester. The counts of interfaces, VLANs, IP
+routers and IP static hosts are divided by weight with the largest remainder
+method, so the shards add up to the configured totals. VLAN, router and host
+blocks of later shards continue where the previous shard stopped, so no two
+shards use the same VLAN id or address.
+
+Component Max Sessions per sec and Max Sessions stay as they are: components
+use -rateDist.scope per_if, so both are limits per client interface and the
+load follows the interfaces. verify_shards checks the offered load and the
+session limits of the shards against the unsharded config with
+capacity.CapacityPlan.
+
+Everything a shard creates gets the S<n> suffix, and shards on the same
+tester use interface numbers after those of the previous ones, so shards can
+share a tester. Every shard gets its own <prefix>S<n> create.tcl/delete.tcl,
+which can run concurrently.
+"""
+
+from copy import deepcopy
+from ipaddress import IPv4Address
+from math import isclose
+
+from bpauto import SECTIONS, largest_remainder
+from capacity import CapacityPlan
+from matrix import compile_variants, rename_objects
+from netplan import NetworkPlan
+
+# (section, block list, field) split across shards. Component rates and
+# limits are per interface and must not be split as well
+SPLIT_FIELDS = (
+    ('Network', 'Interfaces', 'Count'),
+    ('Network', 'VLANs', 'Count'),
+    ('Network', 'IP Routers', 'Count'),
+    ('Network', 'IP Static Hosts', 'Count'),
+)
+
+
+def _continue_block(blocks, block, shard_block, offset):
+    """Start shard_block offset elements into block."""
+    if blocks == 'VLANs':
+        shard_block['VLAN ID'] = block['VLAN ID'] + offset * block['Increment']
+        return
+    step = int(IPv4Address(block['Increment Mask']))
+    for key in ('IP Address', 'Gateway'):
+        if block.get(key) is not None:
+            shard_block[key] = str(IPv4Address(block[key]) + offset * step)
+
+
+def _interface_numbers(net_conf):
+    return {number for interfaces in NetworkPlan(net_conf).interfaces for number in interfaces['numbers']}
+
+
+def _blocks(conf, section, blocks):
+    return (conf.get(section) or {}).get(blocks) or []
+
+
+def shard_config(conf):
+    """Return [(name, conf)] with one config per entry of the Shards section."""
+    shards = conf['Shards']
+    weights = [shard.get('Weight', 1) for shard in shards]
+    base = {key: value for key, value in conf.items() if key != 'Shards'}
+    shard_confs = [deepcopy(base) for _ in shards]
+
+    for shard, shard_conf in zip(shards, shard_confs):
+        connection = shard_conf['Connection']
+        for key in ('Tester IP', 'Login', 'Password'):
+            connection[key] = shard.get(key, connection[key])
+        if 'FileUpload' in shard_conf:
+            shard_conf['FileUpload']['Tester IP'] = connection['Tester IP']
+
+    for section, blocks, field in SPLIT_FIELDS:
+        for index, block in enumerate(_blocks(conf, section, blocks)):
+            parts = largest_remainder(block[field], weights)
+            if 0 in parts:
+                raise ValueError('{0} "{1}": {2} {3} is too small to split across {4} testers'.format(
+                                 blocks, block['Name'], field, block[field], len(shards)))
+            for part, shard_conf in zip(parts, shard_confs):
+                shard_conf[section][blocks][index][field] = part
+
+    # Later shards continue VLAN ids and addresses where the previous one stopped
+    for blocks in ('VLANs', 'IP Routers', 'IP Static Hosts'):
+        for index, block in enumerate(_blocks(conf, 'Network', blocks)):
+            offset = 0
+            for shard_conf in shard_confs:
+                shard_block = shard_conf['Network'][blocks][index]
+                _continue_block(blocks, block, shard_block, offset)
+                offset += shard_block['Count']
+
+    # Shards on the same tester use the interface numbers after those of the previous ones
+    last_number = {}
+    for shard_conf in shard_confs:
+        interfaces = _blocks(shard_conf, 'Network', 'Interfaces')
+        if not interfaces:
+            continue
+        tester = shard_conf['Connection']['Tester IP']
+        if tester in last_number:
+            # A multiple of the increments keeps client and server interfaces interleaved as configured
+            step = max(block['Increment'] for block in interfaces)
+            start = min(block['Start Number'] for block in interfaces)
+            shift = max(0, -(-(last_number[tester] + 1 - start) // step) * step)
+            for block in interfaces:
+                block['Start Number'] += shift
+        last_number[tester] = max(_interface_numbers(shard_conf['Network']))
+
+    named = []
+    for number, shard_conf in enumerate(shard_confs, 1):
+        name = 'S{0}'.format(number)
+        rename_objects(shard_conf, {section for section in SECTIONS if section in shard_conf}, ' ' + name)
+        named.append((name, shard_conf))
+    return named
+
+
+def verify_shards(conf, shard_confs):
+    """Check that the shards offer the load of the config and plan cleanly; returns report lines."""
+    report = []
+    for section, blocks, field in SPLIT_FIELDS:
+        for index, block in enumerate(_blocks(conf, section, blocks)):
+            parts = [shard_conf[section][blocks][index][field] for _, shard_conf in shard_confs]
+            report.append('{0} "{1}" {2}: {3} = {4}'.format(
+                          blocks, block['Name'], field, ' + '.join(map(str, parts)), block[field]))
+    used = {}
+    for name, shard_conf in shard_confs:
+        if 'Network' in shard_conf:
+            numbers = _interface_numbers(shard_conf['Network'])
+            tester = shard_conf['Connection']['Tester IP']
+            for other, other_numbers in used.get(tester, []):
+                if numbers & other_numbers:
+                    raise ValueError('shards {0} and {1} both use interface {2} of tester {3}'.format(
+                                     other, name, min(numbers & other_numbers), tester))
+            used.setdefault(tester, []).append((name, numbers))
+
+    total = CapacityPlan(conf)
+    plans = [CapacityPlan(shard_conf) for _, shard_conf in shard_confs]
+    for superflow, totals in total.superflows.items():
+        for key, unit in (('sessions', 'sessions/s'), ('bits', 'bit/s')):
+            # Shards name their superflows with the shard suffix
+            parts = [plan.superflows.get(superflow + ' ' + name, {}).get(key, 0)
+                     for (name, _), plan in zip(shard_confs, plans)]
+            if totals[key] is None or None in parts:
+                continue
+            if not isclose(sum(parts), totals[key]):
+                raise ValueError('superflow "{0}": shards offer {1:g} {2}, the config {3:g}'.format(
+                                 superflow, sum(parts), unit, totals[key]))
+            report.append('superflow "{0}" {1}: {2} = {3:g}'.format(
+                          superflow, unit, ' + '.join('{0:g}'.format(part) for part in parts), totals[key]))
+
+    # Max Sessions is per client interface, the shards together must allow what the config does
+    for index, component in enumerate(total.components):
+        limit = component['max sessions'] * len(component['client interfaces'])
+        parts = [plan.components[index]['max sessions'] * len(plan.components[index]['client interfaces'])
+                 for plan in plans]
+        if sum(parts) != limit:
+            raise ValueError('component "{0}": shards allow {1} sessions, the config {2}'.format(
+                             component['name'], sum(parts), limit))
+        report.append('component "{0}" Max Sessions: {1} = {2}'.format(
+                      component['name'], ' + '.join(map(str, parts)), limit))
+    return report
+
+
+def run_shards(conf, optimize=False, jobs=None, dry_run=False):
+    shard_confs = shard_config(conf)
+    for line in verify_shards(conf, shard_confs):
+        print(line)
+    if dry_run:
+        for name, shard_conf in shard_confs:
+            print('{0}: {1}'.format(name, shard_conf['Connection']['Tester IP']))
+        return
+    compile_variants(shard_confs, optimize, jobs)
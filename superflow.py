@@ -1,237 +1,131 @@
+"""BreakingPoint superflow applications.
+
+Every supported application is one entry in APPLICATIONS. An entry either
+modifies a template action with the transaction size (Action, Parameter),
+points a template action at an uploaded payload file (Action, Parameter,
+File: True) or repeats an action until the transaction size is reached
+(Command, Min Size, Base Size, Repeat Unit). Applications without an entry
+are created from their template unchanged.
+"""
+
+from functools import lru_cache
+
+_HTTPS_REPEAT = {'Command': 'addAction 1 server application -appdata-min 1400 -appdata-max 1400',
+                 'Min Size': 7250, 'Base Size': 5700, 'Repeat Unit': 1400}
+
+_SYSLOG_CONTENT = 'This is a syslog message.' * 17
+
+APPLICATIONS = {
+    'HTTP': {'Action': 2, 'Parameter': '-response-data-gen-exact'},
+    'HTTPS_TLS12_RSA2K_AES256_SHA384_RESUME': {'Action': 4, 'Parameter': '-response-data-gen-exact'},
+    'GOOGLE_BASE': {'Action': 2, 'Parameter': '-response-data-gen-exact'},
+    'FACEBOOK_BASE': {'Action': 2, 'Parameter': '-response-data-gen-exact'},
+    'SOAP': {'Action': 2, 'Parameter': '-response-data-gen-exact'},
+    'FTP': {'Action': 6, 'Parameter': '-download-size'},
+    'SMBv2': {'Action': 14, 'Parameter': '-file_size'},
+    'POP3': {'Action': 2, 'Parameter': '-attachment_size'},
+    'IMAP': {'Action': 2, 'Parameter': '-attachment_size'},
+    'SMTP': {'Action': 10, 'Parameter': '-attachment-size'},
+    'NFSv3': {'Action': 11, 'Parameter': '-datafile', 'File': True},
+    'RSYNC': {'Action': 5, 'Parameter': '-raw_message_file', 'File': True},
+    'SSH': {'Action': 3, 'Parameter': '-raw_message_file', 'File': True},
+    'QUIC': {'Action': 5, 'Parameter': '-stream_data_file', 'File': True},
+    'HTTPS_SIM': _HTTPS_REPEAT,
+    'GOOGLE_HTTPS': _HTTPS_REPEAT,
+    'PAN_UPDATES': _HTTPS_REPEAT,
+    'FACEBOOK_BASE_HTTPS': _HTTPS_REPEAT,
+    'OUTLOOK_WEB_ONLINE_HTTPS': _HTTPS_REPEAT,
+    'SHAREPOINT_ONLINE_HTTPS': _HTTPS_REPEAT,
+    'NETFLOWv9': {'Command': 'addAction 1 client data_records -num_records 40',
+                  'Min Size': 1500, 'Base Size': 94, 'Repeat Unit': 1309},
+    'SYSLOG': {'Command': 'addAction 1 client syslog_message -content "{0}"'.format(_SYSLOG_CONTENT),
+               'Min Size': 1500, 'Base Size': 94, 'Repeat Unit': 470},
+    'LDAP_SEARCH': {'Command': ('addAction 1 server search_response_resultentry '
+                                '-objectname "CN=Admins,OU=Access Groups,OU=Groups,OU=Test,DC=Test,DC=com" '
+                                '-attributes "Attribute1,Attribute2,Attribute3,Attribute4,Attribute5,Attribute6"'),
+                    'Min Size': 3000, 'Base Size': 1500, 'Repeat Unit': 212},
+    'ORACLE_SELECT': {},
+    'MSSQL_SELECT': {},
+    'MYSQL_SELECT': {},
+    'POSTGRESQL': {},
+    'DB2': {},
+    'LPD': {},
+    'RDP': {},
+    'FIX': {},
+    'TELNET': {},
+    'TFTP': {},
+    'MSRPC': {},
+    'RTSP': {},
+    'SCCP': {},
+    'SIP': {},
+    'SNMPv1': {},
+    'SNMPv2c': {},
+    'SNMPv3': {},
+    'SNMP_TIMEOUT': {},
+    'NETBIOS': {},
+    'DNS': {},
+    'DNS_TIMEOUT': {},
+    'NTPv4': {},
+    'NTPv4_TIMEOUT': {},
+    'CITRIX': {},
+}
+
+
+_BUILTIN_APPLICATIONS = dict(APPLICATIONS)
+
+_REPEAT_KEYS = ('Min Size', 'Base Size', 'Repeat Unit')
+
+
+def register_applications(applications):
+    """Set the applications of one config: the built-ins plus its Applications section.
+
+    Entries registered for an earlier config are dropped, so configs loaded one
+    after another in the same process (--watch, matrix, shards) do not see each
+    other's applications.
+    """
+    for app, entry in applications.items():
+        missing = [key for key in _REPEAT_KEYS if 'Command' in (entry or {}) and key not in entry]
+        if missing:
+            raise ValueError('Application "{0}" has a Command but no {1}'.format(app, ', '.join(missing)))
+    APPLICATIONS.clear()
+    APPLICATIONS.update(_BUILTIN_APPLICATIONS)
+    for app, entry in applications.items():
+        APPLICATIONS[app] = dict(entry or {})
+    repeat_count.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def repeat_count(app, tsize):
+    """Number of repeated actions needed to reach tsize."""
+    entry = APPLICATIONS[app]
+    tsize = max(tsize, entry['Min Size'])
+    loop = round((tsize - entry['Base Size'])/entry['Repeat Unit'])
+    return max(0, loop - 1)
+
+
 class SuperFlow(object):
     def __init__(self, tfiles, name, app):
+        if app not in APPLICATIONS:
+            raise ValueError('Unsupported application: ' + app)
         self.name = name
         self._app = app
+        self._entry = APPLICATIONS[app]
         self.tfiles = tfiles
 
     def modify(self, *, tsize=None, filename=None):
-        pass
+        entry = self._entry
+        if 'Command' in entry:
+            command = '$superflow ' + entry['Command']
+            self.tfiles.prepeat(command, repeat_count(self._app, tsize))
+        elif 'Action' in entry:
+            command = ('$superflow modifyAction {ACTION} {PARAMETER} {VALUE}')
+            value = filename if entry.get('File') else tsize
+            if entry.get('File'):
+                self.tfiles.teardown.add('payload', filename)
+                self.tfiles.teardown.use(('superflow', self.name), 'payload', filename)
+            self.tfiles.pcreate(command.format(ACTION=entry['Action'], PARAMETER=entry['Parameter'], VALUE=value))
 
     def save(self):
         command = ('$superflow save -force')
         self.tfiles.pcreate(command)
-
-
-class HTTP(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -response-data-gen-exact {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class HTTPS_TLS12_RSA2K_AES256_SHA384_RESUME(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 4 -response-data-gen-exact {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class GOOGLE_BASE(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -response-data-gen-exact {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class FACEBOOK_BASE(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -response-data-gen-exact {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class SOAP(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -response-data-gen-exact {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class FTP(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 6 -download-size {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class SMBv2(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 14 -file_size {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class POP3(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -attachment_size {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class IMAP(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 2 -attachment_size {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class SMTP(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 10 -attachment-size {TSIZE}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class NFSv3(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 11 -datafile {FILENAME}')
-        self.tfiles.pcreate(command.format(FILENAME=filename))
-
-class RSYNC(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 5 -raw_message_file {FILENAME}')
-        self.tfiles.pcreate(command.format(TSIZE=tsize))
-
-class SSH(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 3 -raw_message_file {FILENAME}')
-        self.tfiles.pcreate(command.format(FILENAME=filename))
-
-class QUIC(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        command = ('$superflow modifyAction 5 -stream_data_file {FILENAME}')
-        self.tfiles.pcreate(command.format(FILENAME=filename))
-
-class HTTPS_SIM(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class GOOGLE_HTTPS(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class PAN_UPDATES(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class FACEBOOK_BASE_HTTPS(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class OUTLOOK_WEB_ONLINE_HTTPS(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class SHAREPOINT_ONLINE_HTTPS(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 7250:
-            tsize = 7250
-        loop = round((tsize - 5700)/1400)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server application -appdata-min 1400 -appdata-max 1400')
-            self.tfiles.pcreate(command)
-
-class NETFLOWv9(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 1500:
-            tsize = 1500 
-        loop = round((tsize - 94)/1309)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 client data_records -num_records 40')
-            self.tfiles.pcreate(command)
-
-class SYSLOG(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 1500:
-            tsize = 1500
-        loop = round((tsize - 94)/470)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 client syslog_message -content "This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message.This is a syslog message."')
-            self.tfiles.pcreate(command)
-
-class LDAP_SEARCH(SuperFlow):
-    def modify(self, *, tsize=None, filename=None):
-        if tsize < 3000:
-            tsize = 3000 
-        loop = round((tsize - 1500)/212)
-        for i in range(1, loop):
-            command = ('$superflow addAction 1 server search_response_resultentry -objectname "CN=Admins,OU=Access Groups,OU=Groups,OU=Test,DC=Test,DC=com" -attributes "Attribute1,Attribute2,Attribute3,Attribute4,Attribute5,Attribute6"')
-            self.tfiles.pcreate(command)
-
-class ORACLE_SELECT(SuperFlow):
-    pass
-
-class MSSQL_SELECT(SuperFlow):
-    pass
-
-class MYSQL_SELECT(SuperFlow):
-    pass
-
-class POSTGRESQL(SuperFlow):
-    pass
-
-class DB2(SuperFlow):
-    pass
-
-class LPD(SuperFlow):
-    pass
-
-class RDP(SuperFlow):
-    pass
-
-class FIX(SuperFlow):
-    pass
-
-class TELNET(SuperFlow):
-    pass
-
-class TFTP(SuperFlow):
-    pass
-
-class MSRPC(SuperFlow):
-    pass
-
-class RTSP(SuperFlow):
-    pass
-
-class SCCP(SuperFlow):
-    pass
-
-class SIP(SuperFlow):
-    pass
-
-class SNMPv1(SuperFlow):
-    pass
-
-class SNMPv2c(SuperFlow):
-    pass
-
-class SNMPv3(SuperFlow):
-    pass
-
-class SNMP_TIMEOUT(SuperFlow):
-    pass
-
-class NETBIOS(SuperFlow):
-    pass
-
-class DNS(SuperFlow):
-    pass
-
-class DNS_TIMEOUT(SuperFlow):
-    pass
-
-class NTPv4(SuperFlow):
-    pass
-
-class NTPv4_TIMEOUT(SuperFlow):
-    pass
-
-class CITRIX(SuperFlow):
-    pass
-
+        self.tfiles.end_unit()
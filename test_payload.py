@@ -0,0 +1,199 @@
+"""PayloadUploader and delete_files against a local stand-in for the tester.
+
+StandInServer plays the tester's SSH side: commands run in a local shell
+with /resources/ mapped to a temporary directory, and SCP puts copy files
+into it, slowly enough for concurrent uploads to overlap. Runs under pytest
+or on its own:
+
+    python3 test_payload.py
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import types
+from tempfile import TemporaryDirectory
+
+import payload
+from payload import RESOURCES, MANIFEST, PayloadFile, PayloadUploader
+
+
+class _Output(object):
+    def __init__(self, result):
+        self._result = result
+        self.channel = self
+
+    def read(self):
+        return self._result.stdout
+
+    def recv_exit_status(self):
+        return self._result.returncode
+
+
+class StandInServer(object):
+    def __init__(self, root, put_seconds=0.1):
+        self.root = root
+        self.put_seconds = put_seconds
+        self.failing = set()
+        self.commands = []
+        self.connections = 0
+        self.puts = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def path(self, remote):
+        return remote.replace(RESOURCES, self.root + '/')
+
+    # paramiko.SSHClient side
+    def connect(self, hostname, adminlogin, adminpassword):
+        self.connections += 1
+        return self
+
+    def get_transport(self):
+        return self
+
+    def exec_command(self, command):
+        with self._lock:
+            self.commands.append(command)
+        result = subprocess.run(['sh', '-c', self.path(command)], stdout=subprocess.PIPE)
+        return None, _Output(result), None
+
+    def close(self):
+        pass
+
+    # scp.SCPClient side
+    def put(self, localpath, remote):
+        name = remote[len(RESOURCES):]
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.put_seconds)
+            if name in self.failing:
+                raise OSError('scp: {0}: No space left on device'.format(remote))
+            shutil.copyfile(localpath, self.path(remote))
+            with self._lock:
+                self.puts.append(name)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def _scp_module():
+    module = types.ModuleType('scp')
+
+    class SCPClient(object):
+        def __init__(self, transport):
+            self.put = transport.put
+
+        def close(self):
+            pass
+
+    module.SCPClient = SCPClient
+    return module
+
+
+def _run(check):
+    with TemporaryDirectory() as directory:
+        root = os.path.join(directory, 'resources')
+        local = os.path.join(directory, 'local')
+        os.mkdir(root)
+        os.mkdir(local)
+        server = StandInServer(root)
+        connect, scp = payload.connect, sys.modules.get('scp')
+        payload.connect = server.connect
+        sys.modules['scp'] = _scp_module()
+        try:
+            check(server, PayloadFile(cache_dir=local), local)
+        finally:
+            payload.connect = connect
+            if scp is None:
+                del sys.modules['scp']
+            else:
+                sys.modules['scp'] = scp
+
+
+def _localpath(payload_file, local, name):
+    return payload_file.cached_file(os.path.join(local, name), 1000, 'binary', seed=name)
+
+
+def _upload(payload_file, local, names, workers=4):
+    with PayloadUploader(payload_file, 'tester', 'admin', 'admin', workers=workers) as uploader:
+        futures = {name: uploader.submit(name, _localpath(payload_file, local, name)) for name in names}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except OSError as e:
+            results[name] = e
+    return results
+
+
+def _manifest(server):
+    with open(server.path(MANIFEST)) as manifest:
+        return {line.split('  ', 1)[1] for line in manifest.read().splitlines()}
+
+
+def test_concurrent_uploads():
+    def check(server, payload_file, local):
+        names = ['a', 'b', 'c', 'd']
+        assert _upload(payload_file, local, names) == dict.fromkeys(names, True)
+        assert server.connections == 1
+        assert server.max_active > 1
+        assert sorted(server.puts) == names
+        assert _manifest(server) == set(names)
+        for name in names:
+            with open(os.path.join(server.root, name), 'rb') as remote, \
+                 open(_localpath(payload_file, local, name), 'rb') as localfile:
+                assert remote.read() == localfile.read()
+    _run(check)
+
+
+def test_manifest_skip():
+    def check(server, payload_file, local):
+        _upload(payload_file, local, ['a', 'b'])
+        assert _upload(payload_file, local, ['a', 'b']) == {'a': False, 'b': False}
+        assert len(server.puts) == 2
+        # A file removed behind the manifest's back is uploaded again
+        os.remove(os.path.join(server.root, 'a'))
+        assert _upload(payload_file, local, ['a', 'b']) == {'a': True, 'b': False}
+        assert len(server.puts) == 3
+    _run(check)
+
+
+def test_upload_error():
+    def check(server, payload_file, local):
+        server.failing.add('b')
+        results = _upload(payload_file, local, ['a', 'b', 'c'])
+        assert results['a'] is True and results['c'] is True
+        assert isinstance(results['b'], OSError)
+        assert _manifest(server) == {'a', 'c'}
+        assert not os.path.exists(os.path.join(server.root, 'b'))
+        # The failed upload is retried on the next run, the others are skipped
+        server.failing.clear()
+        assert _upload(payload_file, local, ['a', 'b', 'c']) == {'a': False, 'b': True, 'c': False}
+    _run(check)
+
+
+def test_delete_files():
+    def check(server, payload_file, local):
+        _upload(payload_file, local, ['a', 'b', 'c'])
+        connections, commands = server.connections, len(server.commands)
+        payload_file.delete_files(['a', 'b'], 'tester', 'admin', 'admin')
+        assert server.connections == connections + 1
+        assert len(server.commands) == commands + 1
+        assert sorted(os.listdir(server.root)) == ['.bpauto_manifest', 'c']
+        # Manifest entries of deleted files do not make later uploads skip
+        assert _upload(payload_file, local, ['a', 'c']) == {'a': True, 'c': False}
+    _run(check)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')